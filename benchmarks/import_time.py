@@ -0,0 +1,73 @@
+# checks that importing the package stays cheap, exiting nonzero when an
+# import goes over its budget or pulls in a heavy dependency eagerly
+#
+#   python benchmarks/import_time.py
+#   python benchmarks/import_time.py --budget-scale 2
+#
+# each statement is timed in a fresh interpreter, taking the fastest of
+# several runs so a cold disk cache doesn't fail the check
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from typing import List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ['numpy', 'requests', 'urllib3', 'tqdm', 'prettytable', 'tarfile', 'pandas', 'pyarrow']
+
+# statement, budget in milliseconds, heavy modules it is allowed to load
+CHECKS: List[Tuple[str, float, List[str]]] = [
+    ('import forefront', 10.0, []),
+    ('from forefront import predict', 20.0, []),
+    ('from forefront import RaggedArray', 200.0, ['numpy']),
+]
+
+
+def measure(statement: str, home: str) -> Tuple[float, List[str]]:
+    code = (f'import json, sys, time\n'
+            f'start = time.perf_counter()\n'
+            f'{statement}\n'
+            f'print(json.dumps([time.perf_counter() - start, sorted(sys.modules)]))')
+    env = dict(os.environ, HOME=home, PYTHONPATH=ROOT)
+    res = subprocess.run([sys.executable, '-c', code], env=env, cwd=home,
+                         stdout=subprocess.PIPE, check=True)
+
+    seconds, modules = json.loads(res.stdout.decode().strip().splitlines()[-1])
+    return seconds * 1000, [m for m in HEAVY_MODULES if m in modules]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the import time budget of the forefront package')
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per statement')
+    parser.add_argument('--budget-scale', type=float, default=1.0, help='multiplier for slow machines')
+    args = parser.parse_args()
+
+    failures: List[str] = []
+    with tempfile.TemporaryDirectory() as home:
+        for statement, budget, allowed in CHECKS:
+            results = [measure(statement, home) for _ in range(args.runs)]
+            best = min(ms for ms, _ in results)
+            loaded = [m for m in results[0][1] if m not in allowed]
+            budget *= args.budget_scale
+
+            status = 'ok'
+            if best > budget:
+                status = 'over budget'
+                failures.append(f'{statement}: {best:.1f}ms > {budget:.1f}ms')
+            if len(loaded) > 0:
+                status = 'eager imports'
+                failures.append(f'{statement}: imports {", ".join(loaded)}')
+
+            print(f'{statement:<40}{best:>8.1f}ms {budget:>8.1f}ms  {status}')
+
+    if len(failures) > 0:
+        for failure in failures:
+            print(failure, file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+# benchmarks for the client's throughput paths against a local stub server
+#
+#   python benchmarks/run.py --output before.json
+#   python benchmarks/run.py --compare before.json
+#   python benchmarks/run.py upload get_dataloader --latency-ms 20 --bandwidth-mbps 200
+#
+# each benchmark runs in a fresh process and home directory and reports
+# requests/s, MB/s, peak rss and bytes written to disk as json
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Optional, Any, List, Dict, Callable
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from stub_server import StubProcess
+
+MB = 1024 * 1024
+
+
+def read_io_write_bytes() -> Optional[int]:
+    try:
+        with open('/proc/self/io', 'r') as f:
+            for line in f:
+                if line.startswith('write_bytes:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss_bytes() -> int:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macos bytes
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def make_home(home: str, token: str = 'benchmark-token'):
+    root = os.path.join(home, '.forefront')
+    for folder in ['data', 'tar', 'upload']:
+        Path(os.path.join(root, folder)).mkdir(parents=True, exist_ok=True)
+    with open(os.path.join(root, 'config.json'), 'w') as f:
+        json.dump({'token': token}, f)
+
+
+def make_datasets(server: StubProcess) -> Any:
+    from forefront.datasets import Datasets
+
+    datasets = Datasets()
+    datasets.base_endpoint = server.api_url
+    return datasets
+
+
+def make_api(server: StubProcess) -> Any:
+    from forefront.api import API
+
+    api = API('benchmark-token', 'project')
+    api.base_endpoint = server.api_url
+    return api
+
+
+def bench_predict(server: StubProcess, size_mb: float, n: int) -> Dict[str, Any]:
+    import numpy as np
+    from forefront import predict
+
+    data = np.zeros(int(size_mb * MB) // 8)
+    start = time.perf_counter()
+    for _ in range(n):
+        predict(f'{server.url}/predict', data, 'benchmark-token')
+    elapsed = time.perf_counter() - start
+
+    return {'seconds': elapsed, 'operations': n, 'bytes': data.nbytes * n}
+
+
+def bench_upload(server: StubProcess, size_mb: float, n: int) -> Dict[str, Any]:
+    import numpy as np
+
+    datasets = make_datasets(server)
+    x = np.random.default_rng(0).random((int(size_mb * MB) // (8 * 64), 64))
+    y = np.arange(len(x))
+
+    start = time.perf_counter()
+    for _ in range(n):
+        datasets.upload_arrays(x, y, name='benchmark', description='', dataset='benchmark',
+                               shard_bytes=8 * MB)
+    elapsed = time.perf_counter() - start
+
+    return {'seconds': elapsed, 'operations': n, 'bytes': (x.nbytes + y.nbytes) * n}
+
+
+def bench_upload_dataloader(server: StubProcess, size_mb: float, n: int) -> Dict[str, Any]:
+    import numpy as np
+
+    # the iterable path, which runs python for every sample
+    datasets = make_datasets(server)
+    x = np.random.default_rng(0).random((int(size_mb * MB) // (8 * 64), 64))
+    upload_batch = 8 * MB // x[0].nbytes
+
+    def samples():
+        for i in range(len(x)):
+            yield x[i], np.int64(i)
+
+    start = time.perf_counter()
+    for _ in range(n):
+        datasets.upload('benchmark', '', samples(), dataset='benchmark', upload_batch=upload_batch)
+    elapsed = time.perf_counter() - start
+
+    return {'seconds': elapsed, 'operations': n, 'bytes': (x.nbytes + len(x) * 8) * n}
+
+
+def bench_get_dataloader(server: StubProcess, size_mb: float, n: int) -> Dict[str, Any]:
+    import numpy as np
+
+    datasets = make_datasets(server)
+    x = np.random.default_rng(0).random((int(size_mb * MB) // (8 * 64), 64))
+    version = datasets.upload_arrays(x, name='benchmark', description='', dataset='benchmark',
+                                     shard_bytes=8 * MB)
+
+    n_bytes = 0
+    start = time.perf_counter()
+    for _ in range(n):
+        datasets.reset_deta_folders()
+        for batch in datasets.get_dataloader(version)():
+            n_bytes += sum(a.nbytes for a in batch)
+    elapsed = time.perf_counter() - start
+
+    return {'seconds': elapsed, 'operations': n, 'bytes': n_bytes}
+
+
+def bench_deploy(server: StubProcess, size_mb: float, n: int) -> Dict[str, Any]:
+    from forefront.artifacts import get_artifact_cache
+
+    api = make_api(server)
+    path = os.path.join(tempfile.mkdtemp(), 'model.onnx')
+    with open(path, 'wb') as f:
+        f.write(os.urandom(int(size_mb * MB)))
+
+    elapsed = 0.0
+    for i in range(n):
+        # measure the upload itself rather than the artifact cache
+        get_artifact_cache().load()['artifacts'].clear()
+        start = time.perf_counter()
+        api.deploy_string_path(path, name=f'benchmark-{i}')
+        elapsed += time.perf_counter() - start
+
+    return {'seconds': elapsed, 'operations': n, 'bytes': os.path.getsize(path) * n}
+
+
+BENCHMARKS: Dict[str, Callable[[StubProcess, float, int], Dict[str, Any]]] = {
+    'predict': bench_predict,
+    'upload': bench_upload,
+    'upload_dataloader': bench_upload_dataloader,
+    'get_dataloader': bench_get_dataloader,
+    'deploy': bench_deploy,
+}
+
+
+def run_single(name: str, args: argparse.Namespace) -> Dict[str, Any]:
+    # runs in its own process with its own home directory, and the stub in
+    # another one, so peak rss and disk writes belong to this benchmark's
+    # client alone
+    make_home(os.environ['HOME'])
+
+    with StubProcess(args.latency_ms, args.bandwidth_mbps) as server:
+        written_before = read_io_write_bytes()
+        result = BENCHMARKS[name](server, args.size_mb, args.repeat)
+        written_after = read_io_write_bytes()
+        n_requests = server.get_request_count()
+
+    result.update({
+        'name': name,
+        'requests': n_requests,
+        'requests_per_second': n_requests / result['seconds'],
+        'mb_per_second': result['bytes'] / MB / result['seconds'],
+        'peak_rss_bytes': peak_rss_bytes(),
+        'disk_bytes_written': written_after - written_before if written_before is not None else None,
+    })
+    return result
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: List[Dict[str, Any]], baseline_path: str):
+    with open(baseline_path, 'r') as f:
+        baseline = {r['name']: r for r in json.load(f)['results']}
+
+    print(f"{'benchmark':<20}{'metric':<22}{'baseline':>14}{'current':>14}{'change':>10}", file=sys.stderr)
+    for result in results:
+        old = baseline.get(result['name'])
+        if old is None:
+            continue
+        for metric in ['seconds', 'requests_per_second', 'mb_per_second', 'peak_rss_bytes', 'disk_bytes_written']:
+            if old.get(metric) and result.get(metric) is not None:
+                change = (result[metric] - old[metric]) / old[metric] * 100
+                print(f"{result['name']:<20}{metric:<22}{old[metric]:>14.2f}{result[metric]:>14.2f}{change:>9.1f}%",
+                      file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the forefront client against a local stub server')
+    parser.add_argument('benchmarks', nargs='*', help='any of {}'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('--size-mb', type=float, default=32, help='payload size per operation')
+    parser.add_argument('--repeat', type=int, default=3, help='operations per benchmark')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='added to every stub request')
+    parser.add_argument('--bandwidth-mbps', type=float, default=None, help='stub server bandwidth limit')
+    parser.add_argument('--output', help='write results as json to this path')
+    parser.add_argument('--compare', help='baseline json to compare against')
+    parser.add_argument('--single', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        print(json.dumps(run_single(args.single, args)))
+        return
+
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if len(unknown) > 0:
+        parser.error(f'unknown benchmarks {unknown}')
+
+    results: List[Dict[str, Any]] = []
+    for name in args.benchmarks or list(BENCHMARKS):
+        with tempfile.TemporaryDirectory() as home:
+            env = dict(os.environ, HOME=home)
+            command = [sys.executable, os.path.abspath(__file__), '--single', name,
+                       '--size-mb', str(args.size_mb), '--repeat', str(args.repeat),
+                       '--latency-ms', str(args.latency_ms)]
+            if args.bandwidth_mbps is not None:
+                command += ['--bandwidth-mbps', str(args.bandwidth_mbps)]
+
+            output = subprocess.run(command, env=env, check=True, stdout=subprocess.PIPE).stdout
+            result = json.loads(output.decode().strip().splitlines()[-1])
+            results.append(result)
+            print(f"{name:<20}{result['seconds']:>9.3f}s {result['requests_per_second']:>10.1f} req/s "
+                  f"{result['mb_per_second']:>10.1f} MB/s {result['peak_rss_bytes'] / MB:>9.1f} MB rss",
+                  file=sys.stderr)
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {'size_mb': args.size_mb, 'repeat': args.repeat, 'latency_ms': args.latency_ms,
+                   'bandwidth_mbps': args.bandwidth_mbps},
+        'results': results,
+    }
+
+    if args.compare:
+        compare(results, args.compare)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,372 @@
+import hashlib
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from email.parser import BytesParser
+from urllib.parse import urlsplit, parse_qs
+from urllib.request import urlopen
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Optional, Any, List, Dict, Tuple
+
+
+# an in-memory stand-in for the forefront api, implementing just the routes
+# the client library calls. latency is added to every request and bandwidth
+# throttles request and response bodies.
+class StubState:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.projects: List[Any] = []
+        self.versions: List[Any] = []
+        self.datasets: List[Any] = []
+        self.dataset_versions: List[Any] = []
+        self.manifests: Dict[str, Any] = {}
+        self.shards: Dict[str, List[str]] = {}
+        self.blobs: Dict[str, bytes] = {}
+        self.multipart: Dict[str, Dict[int, bytes]] = {}
+        # the next n part uploads fail with a 500, to exercise retries
+        self.part_failures = 0
+        self.requests = 0
+
+    def put_blob(self, data: bytes) -> str:
+        key = uuid.uuid4().hex
+        with self.lock:
+            self.blobs[key] = data
+        return key
+
+
+def parse_multipart_file(content_type: str, body: bytes) -> bytes:
+    message = BytesParser().parsebytes(b'Content-Type: ' + content_type.encode() + b'\r\n\r\n' + body)
+    for part in message.get_payload():
+        if part.get_param('name', header='content-disposition') == 'file':
+            return part.get_payload(decode=True)
+    raise ValueError('No file field in upload')
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: 'StubServer'
+
+    def setup(self):
+        super().setup()
+        # without this small header and body writes stall on delayed acks
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format: str, *args: Any):
+        pass
+
+    @property
+    def state(self) -> StubState:
+        return self.server.state
+
+    def throttle(self, n_bytes: int):
+        if self.server.bandwidth is not None and n_bytes > 0:
+            time.sleep(n_bytes / self.server.bandwidth)
+
+    def read_body(self) -> bytes:
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length > 0 else b''
+        self.throttle(len(body))
+        return body
+
+    def send(self, status: int, body: bytes = b'', content_type: str = 'application/json',
+             headers: Optional[Dict[str, str]] = None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.throttle(len(body))
+        self.wfile.write(body)
+
+    def send_json(self, data: Any, status: int = 200):
+        self.send(status, json.dumps(data).encode('utf-8'))
+
+    def send_listing(self, items: List[Any]):
+        # listings support ETag revalidation, an endpointId filter and
+        # incremental responses with only the items changed since updatedSince
+        query = parse_qs(urlsplit(self.path).query)
+        if 'endpointId' in query:
+            items = [i for i in items if i.get('endpointId') == query['endpointId'][0]]
+
+        etag = '"{}"'.format(hashlib.sha1(json.dumps(items).encode('utf-8')).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            return self.send(304, headers={'ETag': etag})
+
+        headers = {'ETag': etag}
+        if 'updatedSince' in query:
+            items = [i for i in items if i['createdAt'] >= float(query['updatedSince'][0])]
+            headers['X-Forefront-Incremental'] = 'true'
+        self.send(200, json.dumps(items).encode('utf-8'), headers=headers)
+
+    def handle_request(self, method: str):
+        with self.state.lock:
+            self.state.requests += 1
+        if self.server.latency > 0:
+            time.sleep(self.server.latency)
+
+        path = self.path.split('?')[0]
+        for pattern, route_method, name in ROUTES:
+            match = re.fullmatch(pattern, path)
+            if match and route_method == method:
+                return getattr(self, name)(*match.groups())
+
+        self.read_body()
+        self.send_json({'error': 'not found'}, 404)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PATCH(self):
+        self.handle_request('PATCH')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_HEAD(self):
+        self.handle_request('HEAD')
+
+    # /api/endpoints
+    def create_project(self):
+        body = json.loads(self.read_body() or b'{}')
+        project = {'_id': uuid.uuid4().hex, 'title': body.get('title'), 'orgId': body.get('orgId'),
+                   'liveUrl': f'{self.server.url}/predict', 'createdAt': time.time()}
+        self.state.projects.append(project)
+        self.send_json({'endpointId': project['_id']})
+
+    def get_projects(self):
+        self.send_listing(self.state.projects)
+
+    # /api/versions
+    def create_version(self):
+        body = json.loads(self.read_body() or b'{}')
+        version = dict(body, _id=uuid.uuid4().hex, endpointUrl=f'{self.server.url}/predict',
+                       isCustom=bool(body.get('isCustom')), createdAt=time.time())
+        self.state.versions.append(version)
+        self.send_json({'versionId': version['_id']})
+
+    def get_versions(self):
+        self.send_listing(self.state.versions)
+
+    # /api/upload
+    def upload(self):
+        data = parse_multipart_file(self.headers['Content-Type'], self.read_body())
+        key = self.state.put_blob(data)
+        self.send_json({'image': f'{self.server.url}/blobs/{key}'})
+
+    # /api/upload/multipart
+    def create_multipart_upload(self):
+        self.read_body()
+        upload_id = uuid.uuid4().hex
+        self.state.multipart[upload_id] = {}
+        self.send_json({'uploadId': upload_id})
+
+    def get_multipart_upload(self, upload_id: str):
+        parts = self.state.multipart.get(upload_id)
+        if parts is None:
+            return self.send_json({'error': 'not found'}, 404)
+        self.send_json({'parts': [{'partNumber': n, 'etag': str(len(data))} for n, data in sorted(parts.items())]})
+
+    def upload_part(self, upload_id: str, number: str):
+        data = self.read_body()
+        with self.state.lock:
+            if self.state.part_failures > 0:
+                self.state.part_failures -= 1
+                return self.send_json({'error': 'injected failure'}, 500)
+        if upload_id not in self.state.multipart:
+            return self.send_json({'error': 'not found'}, 404)
+        self.state.multipart[upload_id][int(number)] = data
+        self.send_json({'etag': str(len(data))})
+
+    def complete_multipart_upload(self, upload_id: str):
+        body = json.loads(self.read_body() or b'{}')
+        parts = self.state.multipart.pop(upload_id, None)
+        numbers = [p['partNumber'] for p in body.get('parts', [])]
+        if parts is None or numbers != sorted(parts):
+            return self.send_json({'error': 'missing parts'}, 400)
+        key = self.state.put_blob(b''.join(parts[n] for n in numbers))
+        self.send_json({'image': f'{self.server.url}/blobs/{key}'})
+
+    # /api/datasets
+    def create_dataset(self):
+        body = json.loads(self.read_body() or b'{}')
+        dataset = {'_id': uuid.uuid4().hex, 'name': body.get('name'), 'createdAt': time.time()}
+        self.state.datasets.append(dataset)
+        self.send_json({'datasetId': dataset['_id']})
+
+    def get_datasets(self):
+        self.send_listing(self.state.datasets)
+
+    def create_dataset_version(self, dataset_id: str):
+        body = json.loads(self.read_body() or b'{}')
+        version = {'_id': uuid.uuid4().hex, 'datasetId': dataset_id, 'name': body.get('name'),
+                   'description': body.get('description'), 'createdAt': time.time()}
+        self.state.dataset_versions.append(version)
+        self.state.shards[version['_id']] = []
+        self.send_json({'datasetVersionId': version['_id']})
+
+    def get_dataset_versions(self, dataset_id: str):
+        self.send_listing([v for v in self.state.dataset_versions if v['datasetId'] == dataset_id])
+
+    def get_dataset_version(self, dataset_id: str, version_id: str):
+        versions = [v for v in self.state.dataset_versions if v['_id'] == version_id]
+        if len(versions) == 0:
+            return self.send_json({'error': 'not found'}, 404)
+        self.send_json(dict(versions[0], manifest=self.state.manifests.get(version_id)))
+
+    def patch_dataset_version(self, dataset_id: str, version_id: str):
+        body = json.loads(self.read_body() or b'{}')
+        if 'manifest' in body:
+            self.state.manifests[version_id] = body['manifest']
+        self.send_json({'ok': True})
+
+    def upload_dataset_data(self, dataset_id: str, version_id: str):
+        data = parse_multipart_file(self.headers['Content-Type'], self.read_body())
+        key = self.state.put_blob(data)
+        with self.state.lock:
+            self.state.shards.setdefault(version_id, []).append(key)
+        self.send_json({'file': f'{self.server.url}/blobs/{key}'})
+
+    def get_dataset_data(self, dataset_id: str, version_id: str, index: str):
+        # shards are served 0-indexed, in upload order
+        keys = self.state.shards.get(version_id, [])
+        if int(index) >= len(keys):
+            return self.send_json({'error': 'not found'}, 404)
+        self.send_json({'url': f'{self.server.url}/blobs/{keys[int(index)]}'})
+
+    # signed url fetches
+    def get_blob(self, key: str):
+        data = self.state.blobs.get(key)
+        if data is None:
+            return self.send_json({'error': 'not found'}, 404)
+
+        byte_range = self.headers.get('Range')
+        if byte_range is not None:
+            start, end = re.fullmatch(r'bytes=(\d+)-(\d*)', byte_range).groups()
+            start, end = int(start), min(int(end) + 1 if end else len(data), len(data))
+            return self.send(206, data[start:end], 'application/octet-stream',
+                             {'Content-Range': f'bytes {start}-{end - 1}/{len(data)}'})
+        self.send(200, data, 'application/octet-stream')
+
+    def head_blob(self, key: str):
+        data = self.state.blobs.get(key)
+        self.send_response(200 if data is not None else 404)
+        self.send_header('Content-Length', str(len(data) if data is not None else 0))
+        self.end_headers()
+
+    # model endpoint used by predict()
+    def predict(self):
+        body = self.read_body()
+        self.send_json({'result': len(body)})
+
+    # requests served so far, not counting this one
+    def get_request_count(self):
+        self.send_json({'requests': self.state.requests - 1})
+
+
+ROUTES: List[Tuple[str, str, str]] = [
+    (r'/api/endpoints', 'POST', 'create_project'),
+    (r'/api/endpoints', 'GET', 'get_projects'),
+    (r'/api/versions', 'POST', 'create_version'),
+    (r'/api/versions', 'GET', 'get_versions'),
+    (r'/api/upload', 'POST', 'upload'),
+    (r'/api/upload/multipart', 'POST', 'create_multipart_upload'),
+    (r'/api/upload/multipart/([^/]+)', 'GET', 'get_multipart_upload'),
+    (r'/api/upload/multipart/([^/]+)/(\d+)', 'PUT', 'upload_part'),
+    (r'/api/upload/multipart/([^/]+)/complete', 'POST', 'complete_multipart_upload'),
+    (r'/api/datasets', 'POST', 'create_dataset'),
+    (r'/api/datasets', 'GET', 'get_datasets'),
+    (r'/api/datasets/([^/]+)/versions', 'POST', 'create_dataset_version'),
+    (r'/api/datasets/([^/]+)/versions', 'GET', 'get_dataset_versions'),
+    (r'/api/datasets/([^/]+)/versions/([^/]+)', 'GET', 'get_dataset_version'),
+    (r'/api/datasets/([^/]+)/versions/([^/]+)', 'PATCH', 'patch_dataset_version'),
+    (r'/api/datasets/([^/]+)/versions/([^/]+)/data', 'POST', 'upload_dataset_data'),
+    (r'/api/datasets/([^/]+)/versions/([^/]+)/data/(\d+)', 'GET', 'get_dataset_data'),
+    (r'/blobs/([^/]+)', 'GET', 'get_blob'),
+    (r'/blobs/([^/]+)', 'HEAD', 'head_blob'),
+    (r'/predict', 'POST', 'predict'),
+    (r'/_stub/requests', 'GET', 'get_request_count'),
+]
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency_ms: float = 0.0, bandwidth_mbps: Optional[float] = None, port: int = 0):
+        super().__init__(('127.0.0.1', port), StubHandler)
+        self.state = StubState()
+        self.latency = latency_ms / 1000
+        self.bandwidth = bandwidth_mbps * 1e6 / 8 if bandwidth_mbps else None
+        self.url = f'http://127.0.0.1:{self.server_port}'
+        self.api_url = f'{self.url}/api'
+        self.thread: Optional[threading.Thread] = None
+
+    def handle_error(self, request: Any, client_address: Any):
+        # clients hang up mid-response on purpose, e.g. after peeking at a shard
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+    def __enter__(self) -> 'StubServer':
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args: Any):
+        self.shutdown()
+        self.server_close()
+
+
+class StubProcess:
+    # the stub server in a child process, so the blobs it keeps in memory
+    # don't count towards the caller's rss
+    url: str
+    api_url: str
+
+    def __init__(self, latency_ms: float = 0.0, bandwidth_mbps: Optional[float] = None):
+        self.command = [sys.executable, os.path.abspath(__file__), '--port', '0', '--latency-ms', str(latency_ms)]
+        if bandwidth_mbps is not None:
+            self.command += ['--bandwidth-mbps', str(bandwidth_mbps)]
+        self.process: Optional[subprocess.Popen] = None
+
+    def get_request_count(self) -> int:
+        with urlopen(f'{self.url}/_stub/requests') as res:
+            return json.load(res)['requests']
+
+    def __enter__(self) -> 'StubProcess':
+        self.process = subprocess.Popen(self.command, stdout=subprocess.PIPE)
+        line = self.process.stdout.readline().decode()
+        if not line.startswith('Stub server listening on '):
+            self.process.kill()
+            raise RuntimeError('The stub server failed to start')
+
+        self.api_url = line.split()[-1]
+        self.url = self.api_url[:-len('/api')]
+        return self
+
+    def __exit__(self, *args: Any):
+        self.process.terminate()
+        self.process.wait()
+        self.process.stdout.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run a local stand-in Forefront server')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--bandwidth-mbps', type=float, default=None)
+    args = parser.parse_args()
+
+    with StubServer(args.latency_ms, args.bandwidth_mbps, args.port) as server:
+        print(f'Stub server listening on {server.api_url}', flush=True)
+        server.thread.join()
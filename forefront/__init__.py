@@ -1 +1,43 @@
-from forefront.forefront import Forefront, predict
+import sys
+from typing import Any, List, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from forefront.forefront import Forefront
+    from forefront.inference import predict
+    from forefront.packaging import save_model, load_model
+    from forefront.ragged import RaggedArray
+
+# public names are resolved on first access, so `import forefront` does not
+# pay for numpy, requests and the dataset machinery until they are used
+LAZY_ATTRIBUTES = {
+    'Forefront': 'forefront.forefront',
+    'predict': 'forefront.inference',
+    'RaggedArray': 'forefront.ragged',
+    'save_model': 'forefront.packaging',
+    'load_model': 'forefront.packaging',
+}
+
+__all__ = list(LAZY_ATTRIBUTES)
+
+
+def __getattr__(name: str) -> Any:
+    if name not in LAZY_ATTRIBUTES:
+        raise AttributeError(f"module 'forefront' has no attribute '{name}'")
+
+    import importlib
+
+    value = getattr(importlib.import_module(LAZY_ATTRIBUTES[name]), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> List[str]:
+    return sorted(list(globals()) + __all__)
+
+
+if sys.version_info < (3, 7):
+    # module __getattr__ (PEP 562) needs python 3.7, older interpreters
+    # import everything up front as before
+    for _name in __all__:
+        __getattr__(_name)
+    del _name
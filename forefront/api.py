@@ -1,16 +1,61 @@
-import requests
-from typing import Optional, Mapping, NoReturn, Any, List, Union
-import tarfile
+from typing import Optional, Mapping, NoReturn, Any, List, Union, Tuple, TYPE_CHECKING
 import os.path
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-import pickle
+from . import instrumentation
+from .state import State
+from .metadata import get_metadata_cache
+from .artifacts import get_artifact_cache
+
+if TYPE_CHECKING:
+    import requests
+
+MB = 1024 * 1024
+
+# artifacts at least this large go up in parts over several connections,
+# smaller ones in a single request
+MULTIPART_THRESHOLD = 64 * MB
+PART_SIZE = 16 * MB
+UPLOAD_WORKERS = 4
+PART_RETRIES = 3
+# seconds to connect and to wait on a stalled connection, so a half-open
+# socket fails the request and the part gets retried
+UPLOAD_TIMEOUT = (10, 60)
 
 
 def make_tarfile(output_filename: str, source_dir: str):
+    import tarfile
+
     with tarfile.open(output_filename, "w:gz") as tar:
         tar.add(source_dir, arcname=os.path.basename(source_dir))
 
 
+def get_account(key: str) -> str:
+    # artifact urls differ per account, so cached entries are scoped to the token
+    import hashlib
+
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+
+
+def hash_file(path: str) -> str:
+    import hashlib
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(MB), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_part(path: str, offset: int, length: int) -> bytes:
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return f.read(length)
+
+
 class API:
     key: str
     endpoints: Mapping[str, str]
@@ -18,13 +63,26 @@ class API:
     base_endpoint: str
     organization_id: str
     project_id: str
-
-    def __init__(self, key: str, project_id: str, organization_id: Optional[str] = None):
+    state: State
+    multipart_threshold: int
+    part_size: int
+    upload_workers: int
+    part_retries: int
+    upload_timeout: Tuple[float, float]
+
+    def __init__(self, key: str, project_id: str, organization_id: Optional[str] = None,
+                 state: Optional[State] = None):
         self.key = key
         self.project_id = project_id
         self.organization_id = organization_id
         self.base_endpoint = 'https://live-server.forefront.link/api'
+        self.state = state if state is not None else State()
 
+        self.multipart_threshold = MULTIPART_THRESHOLD
+        self.part_size = PART_SIZE
+        self.upload_workers = UPLOAD_WORKERS
+        self.part_retries = PART_RETRIES
+        self.upload_timeout = UPLOAD_TIMEOUT
 
         self.endpoints = {
             'create_project': 'endpoints',
@@ -42,11 +100,11 @@ class API:
             'get_projects': 'GET'
         }
 
-    def make_request(self, action: str, body=None) -> requests.Response:
+    def make_request(self, action: str, body=None) -> 'requests.Response':
         endpoint = self.make_endpoint(action)
         method = self.methods[action]
-        return requests.request(method=method, url=endpoint, json=body,
-                                headers={'Authorization': self.key, 'Content-Type': 'application/json'})
+        return instrumentation.request(method, endpoint, stage=action, json=body,
+                                       headers={'Authorization': self.key, 'Content-Type': 'application/json'})
 
     def make_endpoint(self, name: str) -> str:
         return f'{self.base_endpoint}/{self.endpoints[name]}'
@@ -62,51 +120,234 @@ class API:
         try:
             action = 'create_project'
             response = self.make_request(action=action, body=body)
+            get_metadata_cache().invalidate(self.make_endpoint('get_projects'))
 
             return response.json()['endpointId']
 
         except Exception as e:
             raise e
 
-    def get_versions(self) -> List[Any]:
+    def get_versions(self, project_id: Optional[str] = None, refresh: bool = False) -> List[Any]:
         try:
             action = 'get_versions'
-            response = self.make_request(action=action)
+            # servers that support it only return the project's versions,
+            # the filter below covers the ones that ignore the parameter
+            params = {'endpointId': project_id} if project_id else None
+            versions = get_metadata_cache().get(self.make_endpoint(action), self.key, params=params,
+                                                stage=action, refresh=refresh)
 
-            return response.json()
+            if project_id:
+                return [v for v in versions if v['endpointId'] == project_id]
+            return versions
 
         except Exception as e:
             raise e
 
-    def get_projects(self) -> List[Any]:
+    def get_projects(self, refresh: bool = False) -> List[Any]:
         try:
             action = 'get_projects'
-            response = self.make_request(action=action)
-
-            return response.json()
+            return get_metadata_cache().get(self.make_endpoint(action), self.key, stage=action, refresh=refresh)
 
         except Exception as e:
             raise e
 
-    def upload_file(self, file_path: str) -> str:
+    def upload_file(self, file_path: str, digest: Optional[str] = None) -> str:
+        if digest is None:
+            with instrumentation.span('upload.hash', stage='upload'):
+                digest = hash_file(file_path)
+
+        url = self.get_cached_artifact(digest)
+        if url is not None:
+            print(f'{os.path.basename(file_path)} is unchanged since it was last uploaded, skipping the upload')
+            return url
+
+        size = os.path.getsize(file_path)
+        if size >= self.multipart_threshold:
+            url = self.upload_file_multipart(file_path, size, digest)
+        if url is None:
+            url = self.upload_file_single(file_path)
+
+        self.set_cached_artifact(digest, url)
+        return url
+
+    def artifact_exists(self, url: str) -> bool:
+        res = instrumentation.request('HEAD', url, stage='upload.check', allow_redirects=True)
+        if res.status_code in (403, 405):
+            # signed urls are often only valid for GET
+            res = instrumentation.request('GET', url, stage='upload.check', stream=True,
+                                          headers={'Range': 'bytes=0-0'})
+            res.close()
+        return res.status_code in (200, 206)
+
+    def make_artifact_key(self, digest: str) -> str:
+        return f'{get_account(self.key)}:{digest}'
+
+    def get_cached_artifact(self, digest: str) -> Optional[str]:
+        cache_key = self.make_artifact_key(digest)
+        url = get_artifact_cache().get_artifact(cache_key)
+        if url is None:
+            return None
+
+        try:
+            if self.artifact_exists(url):
+                return url
+        except OSError:
+            pass
+
+        get_artifact_cache().remove_artifact(cache_key)
+        return None
+
+    def set_cached_artifact(self, digest: str, url: str):
+        get_artifact_cache().set_artifact(self.make_artifact_key(digest), url)
+
+    def upload_file_single(self, file_path: str) -> str:
 
         try:
 
-            response = requests.post(self.make_endpoint(self.endpoints['upload']), headers={'Authorization': self.key},
-                                     files={'file': open(file_path, 'rb')})
+            with open(file_path, 'rb') as f:
+                response = instrumentation.request('POST', self.make_endpoint(self.endpoints['upload']),
+                                                   stage='upload', headers={'Authorization': self.key},
+                                                   files={'file': f})
             url: str = response.json()['image']
             return url
 
         except Exception as e:
             raise e
 
-    def deploy_tensorflow(self, model: Any, name: str, description: Optional[str] = None):
-
+    def make_multipart_endpoint(self, *parts: Any) -> str:
+        return '/'.join([self.make_endpoint('upload'), 'multipart'] + [str(p) for p in parts])
+
+    def start_multipart_upload(self, file_path: str, size: int,
+                               digest: str) -> Optional[Tuple[str, int, List[Any]]]:
+        # keyed by content rather than path, so a model converted into a new
+        # temporary folder resumes the upload of the same bytes
+        session_key = self.make_artifact_key(digest)
+        session = get_artifact_cache().get_upload(session_key)
+        if session is not None:
+            res = instrumentation.request('GET', self.make_multipart_endpoint(session['uploadId']),
+                                          stage='upload.resume', headers={'Authorization': self.key},
+                                          timeout=self.upload_timeout)
+            if res.status_code == 200:
+                parts = res.json().get('parts', [])
+                print(f'Resuming upload of {os.path.basename(file_path)}, {len(parts)} parts already uploaded')
+                return session['uploadId'], session['partSize'], parts
+
+        res = instrumentation.request('POST', self.make_multipart_endpoint(), stage='upload.start',
+                                      headers={'Authorization': self.key}, timeout=self.upload_timeout,
+                                      json={'filename': os.path.basename(file_path), 'size': size,
+                                            'partSize': self.part_size})
+        if res.status_code == 404:
+            # the server doesn't support multipart uploads
+            return None
+        if res.status_code != 200:
+            raise Exception('Something went wrong starting the upload!')
+
+        upload_id: str = res.json()['uploadId']
+        get_artifact_cache().set_upload(session_key, {'uploadId': upload_id, 'partSize': self.part_size})
+
+        return upload_id, self.part_size, []
+
+    def upload_part(self, file_path: str, upload_id: str, number: int, offset: int, length: int) -> Any:
+        data = read_part(file_path, offset, length)
+        endpoint = self.make_multipart_endpoint(upload_id, number)
+
+        with instrumentation.span('upload.part', stage='upload') as s:
+            error = ''
+            for attempt in range(self.part_retries + 1):
+                if attempt > 0:
+                    time.sleep(min(0.5 * 2 ** (attempt - 1), 8))
+                    s.set(retries=attempt)
+
+                try:
+                    res = instrumentation.request('PUT', endpoint, stage='upload.part', data=data,
+                                                  timeout=self.upload_timeout,
+                                                  headers={'Authorization': self.key,
+                                                           'Content-Type': 'application/octet-stream'})
+                except OSError as e:
+                    # requests' connection errors and timeouts are OSErrors
+                    error = str(e)
+                    continue
+
+                if res.status_code == 200:
+                    return {'partNumber': number, 'etag': res.json().get('etag')}
+
+                error = f'status {res.status_code}'
+                if res.status_code < 500 and res.status_code != 429:
+                    break
+
+        raise Exception(f'Uploading part {number} failed: {error}')
+
+    def upload_file_multipart(self, file_path: str, size: int, digest: str) -> Optional[str]:
+        from tqdm import tqdm
+
+        started = self.start_multipart_upload(file_path, size, digest)
+        if started is None:
+            return None
+        upload_id, part_size, uploaded = started
+
+        parts = {p['partNumber']: p for p in uploaded}
+        n_parts = max(1, -(-size // part_size))
+
+        def get_part_length(number: int) -> int:
+            return min(part_size, size - (number - 1) * part_size)
+
+        resumed_bytes = sum(get_part_length(n) for n in parts)
+        pbar = tqdm(total=size, initial=resumed_bytes, unit='B', unit_scale=True,
+                    desc=os.path.basename(file_path))
+        start = time.perf_counter()
+
+        with ThreadPoolExecutor(self.upload_workers) as pool:
+            futures = [pool.submit(self.upload_part, file_path, upload_id, n, (n - 1) * part_size,
+                                   get_part_length(n))
+                       for n in range(1, n_parts + 1) if n not in parts]
+            try:
+                for future in as_completed(futures):
+                    part = future.result()
+                    parts[part['partNumber']] = part
+                    pbar.update(get_part_length(part['partNumber']))
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                pbar.close()
+                print('Upload interrupted. Deploying the same file again resumes it.')
+                raise
+
+        pbar.close()
+
+        res = instrumentation.request('POST', self.make_multipart_endpoint(upload_id, 'complete'),
+                                      stage='upload.complete', headers={'Authorization': self.key},
+                                      timeout=self.upload_timeout,
+                                      json={'parts': [parts[n] for n in sorted(parts)]})
+        if res.status_code != 200:
+            raise Exception('Something went wrong completing the upload!')
+
+        get_artifact_cache().remove_upload(self.make_artifact_key(digest))
+
+        elapsed = time.perf_counter() - start
+        print(f'Uploaded {(size - resumed_bytes) / MB:.1f} MB in {elapsed:.1f}s '
+              f'({(size - resumed_bytes) / MB / max(elapsed, 1e-9):.1f} MB/s)')
+
+        url: str = res.json()['image']
+        return url
+
+    def create_version(self, body: Any) -> Optional[str]:
+        response = self.make_request('deploy', body=body)
+        if response.status_code != 200:
+            raise Exception('Something went wrong creating the version!')
+        get_metadata_cache().invalidate(self.make_endpoint('get_versions'))
+
+        print('Deployed successfully!')
+        print(f'Dashboard: https://app.tryforefront.com/endpoints/{self.project_id}')
+
+        return response.json().get('versionId')
+
+    def deploy_onnx(self, convert: Any, name: str, description: Optional[str] = None) -> Optional[str]:
+        # every deploy converts into its own temporary folder, so concurrent
+        # deploys don't overwrite each other's model.onnx
+        folder = tempfile.mkdtemp(prefix='forefront-deploy-')
         try:
-            from forefront_tensorflow import convert_tensorflow_model_to_onnx
-
-            path = os.path.join('.', 'model.onnx')
-            convert_tensorflow_model_to_onnx(model, path=path)
+            path = os.path.join(folder, 'model.onnx')
+            convert(path)
 
             url: str = self.upload_file(path)
             body: Any = {
@@ -116,11 +357,17 @@ class API:
                 'orgId': self.organization_id,
                 'endpointId': self.project_id
             }
-            response = self.make_request('deploy', body=body)
+            return self.create_version(body)
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    def deploy_tensorflow(self, model: Any, name: str, description: Optional[str] = None) -> Optional[str]:
 
-            print('Deployed successfully!')
-            print(f'Dashboard: https://app.tryforefront.com/endpoints/{self.project_id}')
+        try:
+            from forefront_tensorflow import convert_tensorflow_model_to_onnx
 
+            return self.deploy_onnx(lambda path: convert_tensorflow_model_to_onnx(model, path=path),
+                                    name, description)
 
         except ImportError:
             raise ImportError('You must install the forefront tensorflow extension! pip install forefront[tensorflow]')
@@ -129,7 +376,7 @@ class API:
             raise Exception('Something went wrong! Please report on GitHub issues')
 
     def deploy_pytorch(self, model: Any, name: str, description: Optional[str] = None,
-                       input_data: Optional[Any] = None):
+                       input_data: Optional[Any] = None) -> Optional[str]:
 
         try:
             from forefront_pytorch import convert_pytorch_model_to_onnx
@@ -137,22 +384,8 @@ class API:
             if input_data is None:
                 raise Exception('Must include input_data for a pytorch model!')
 
-            path = os.path.join('.', 'model.onnx')
-            convert_pytorch_model_to_onnx(model, input_data, path=path)
-
-            url: str = self.upload_file(path)
-            body: Any = {
-                'title': name,
-                'description': description,
-                'file': url,
-                'orgId': self.organization_id,
-                'endpointId': self.project_id
-            }
-            response = self.make_request('deploy', body=body)
-
-            print('Deployed successfully!')
-            print(f'Dashboard: https://app.tryforefront.com/endpoints/{self.project_id}')
-
+            return self.deploy_onnx(lambda path: convert_pytorch_model_to_onnx(model, input_data, path=path),
+                                    name, description)
 
         except ImportError:
             raise ImportError('You must install the forefront pytorch extension! pip install forefront[pytorch]')
@@ -161,7 +394,7 @@ class API:
             raise Exception('Something went wrong! Please report on GitHub issues')
 
     def deploy_sklearn(self, model: Any, name: str, description: Optional[str] = None,
-                       input_shape: Optional[List[Union[int, None]]] = None):
+                       input_shape: Optional[List[Union[int, None]]] = None) -> Optional[str]:
 
         if input_shape is None or len(input_shape) == 0:
             raise Exception('Must include valid input shape for sklearn model!')
@@ -169,22 +402,8 @@ class API:
         try:
             from forefront_sklearn import convert_sklearn_model_to_onnx
 
-            path = os.path.join('.', 'model.onnx')
-            convert_sklearn_model_to_onnx(model, input_shape, path=path)
-
-            url: str = self.upload_file(path)
-            body: Any = {
-                'title': name,
-                'description': description,
-                'file': url,
-                'orgId': self.organization_id,
-                'endpointId': self.project_id
-            }
-            response = self.make_request('deploy', body=body)
-
-            print('Deployed successfully!')
-            print(f'Dashboard: https://app.tryforefront.com/endpoints/{self.project_id}')
-
+            return self.deploy_onnx(lambda path: convert_sklearn_model_to_onnx(model, input_shape, path=path),
+                                    name, description)
 
         except ImportError:
             raise ImportError('You must install the forefront sklearn extension! pip install forefront[sklearn]')
@@ -192,26 +411,33 @@ class API:
         except Exception:
             raise Exception('Something went wrong! Please report on GitHub issues')
 
-
-    def deploy_string_path(self, path: str, name: str, description: Optional[str] = None):
+    def deploy_string_path(self, path: str, name: str, description: Optional[str] = None) -> Optional[str]:
 
         print('Uploading the file you specified...')
         try:
-            url: str = self.upload_file(path)
             handler_path = os.path.join(Path.home(), '.forefront', f'handler-{self.project_id}.py')
             requirements_path = os.path.join(Path.home(), '.forefront', f'requirements-{self.project_id}.txt')
 
-            if os.path.isfile(handler_path) and os.path.isfile(requirements_path):
-                is_custom = True
-                handler_url: str = self.upload_file(handler_path)
-                requirements_url: str = self.upload_file(requirements_path)
-            else:
+            # the model, handler and requirements don't depend on each other
+            # and upload at the same time
+            with ThreadPoolExecutor(3) as pool:
+                model_upload = pool.submit(self.upload_file, path)
+
+                if os.path.isfile(handler_path) and os.path.isfile(requirements_path):
+                    is_custom = True
+                    handler_upload = pool.submit(self.upload_file, handler_path)
+                    requirements_upload = pool.submit(self.upload_file, requirements_path)
+                    handler_url: Optional[str] = handler_upload.result()
+                    requirements_url: Optional[str] = requirements_upload.result()
+                else:
 
-                print('You have not specified a handler or requirements. Assuming this is a simple framework.')
+                    print('You have not specified a handler or requirements. Assuming this is a simple framework.')
 
-                is_custom = None
-                handler_url = None
-                requirements_url = None
+                    is_custom = None
+                    handler_url = None
+                    requirements_url = None
+
+                url: str = model_upload.result()
 
             body: Any = {
                 'title': name,
@@ -223,63 +449,54 @@ class API:
                 'requirements': requirements_url,
                 'isCustom': is_custom
             }
-            response = self.make_request('deploy', body=body)
-
-            print('Deployed successfully!')
-            print(f'Dashboard: https://app.tryforefront.com/endpoints/{self.project_id}')
-
+            return self.create_version(body)
 
         except Exception as e:
             raise e
 
-    def deploy_custom_model(self, model: Any, name: str, description: Optional[str] = None):
-        path = '~/.forefront/model.pkl'
+    def deploy_custom_model(self, model: Any, name: str, description: Optional[str] = None) -> Optional[str]:
+        from .packaging import save_model, get_model_format
 
-        print('Attempting to save as pickle')
+        model_format = get_model_format()
+        folder = tempfile.mkdtemp(prefix='forefront-deploy-')
+        try:
+            path = os.path.join(folder, f'model.{model_format}')
 
-        with open(path, 'wb') as f:
-            pickle.dump(model, f)
+            print('Packaging the model')
+            with instrumentation.span('deploy.package', stage='deploy'):
+                digest = save_model(model, path)
 
-        try:
-            url: str = self.upload_file(path)
+            url: str = self.upload_file(path, digest=digest)
             body: Any = {
                 'title': name,
                 'description': description,
                 'file': url,
+                'format': model_format,
                 'orgId': self.organization_id,
                 'endpointId': self.project_id
             }
-            response = self.make_request('deploy', body=body)
-
-            print('Deployed successfully!')
-            print(f'Dashboard: https://app.tryforefront.com/endpoints/{self.project_id}')
-
-        except Exception as e:
-            raise e
+            return self.create_version(body)
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
 
     def deploy_version(self, name: str, model: Union[str, Any], description: Optional[str] = None,
                        model_type: Optional[str] = None, input_data: Optional[Any] = None,
-                       input_shape: Optional[List[Union[int, None]]] = None):
+                       input_shape: Optional[List[Union[int, None]]] = None) -> Optional[str]:
 
         if isinstance(model, str):
             # passed a filepath to the model
-            self.deploy_string_path(path=model, name=name, description=description)
-            return
+            return self.deploy_string_path(path=model, name=name, description=description)
 
         if isinstance(model_type, str):
             # model type is specified
             if model_type == 'tensorflow' or model_type == 'keras':
-                self.deploy_tensorflow(model, name, description)
-                return
+                return self.deploy_tensorflow(model, name, description)
             elif model_type == 'pytorch' or model_type == 'torch':
-                self.deploy_pytorch(model, name, description, input_data)
-                return
+                return self.deploy_pytorch(model, name, description, input_data)
             elif model_type == 'custom':
-                self.deploy_custom_model(model, name, description)
-                return
+                return self.deploy_custom_model(model, name, description)
             elif model_type == 'sklearn' or model_type == 'scikit-learn':
-                self.deploy_sklearn(model, name, description, input_shape)
-                return
+                return self.deploy_sklearn(model, name, description, input_shape)
             else:
                 raise Exception('Unknown model type!')
 
@@ -288,14 +505,11 @@ class API:
         model_type_str = str(type(model)).lower()
 
         if 'tensorflow' in model_type_str or 'tf' in model_type_str:
-            self.deploy_tensorflow(model, name, description)
-            return
+            return self.deploy_tensorflow(model, name, description)
         elif 'torch' in model_type_str:
-            self.deploy_pytorch(model, name, description, input_data)
-            return
+            return self.deploy_pytorch(model, name, description, input_data)
         elif 'sklearn' in model_type_str:
-            self.deploy_sklearn(model, name, description, input_shape)
-            return
+            return self.deploy_sklearn(model, name, description, input_shape)
         else:
             raise Exception("Can't infer type of model! Try specifying your model type")
 
@@ -0,0 +1,107 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Optional, Any, Dict
+
+# upload bookkeeping is kept in its own file rather than config.json, so
+# deploys never lock and rewrite the file that holds the credentials
+
+# content hash -> upload url entries remembered
+ARTIFACT_CACHE_SIZE = 100
+
+# unfinished multipart uploads older than this are forgotten rather than
+# resumed, servers expire them eventually
+UPLOAD_SESSION_TTL = 7 * 24 * 60 * 60
+
+
+class ArtifactCache:
+    path: str
+    data: Optional[Dict[str, Any]]
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path if path is not None else os.path.join(Path.home(), '.forefront', 'artifacts.json')
+        self.data = None
+        self.lock = threading.RLock()
+
+    def load(self) -> Dict[str, Any]:
+        with self.lock:
+            if self.data is None:
+                try:
+                    with open(self.path, 'r') as f:
+                        self.data = json.load(f)
+                except (OSError, ValueError):
+                    self.data = {}
+                self.data.setdefault('artifacts', {})
+                self.data.setdefault('uploads', {})
+            return self.data
+
+    def save(self):
+        # last writer wins, at worst an upload is repeated or not resumed.
+        # the rename keeps readers from seeing a partial file
+        try:
+            folder = os.path.dirname(self.path)
+            Path(folder).mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.artifacts-')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.data, f)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass
+
+    def get_artifact(self, key: str) -> Optional[str]:
+        with self.lock:
+            return self.load()['artifacts'].get(key)
+
+    def set_artifact(self, key: str, url: str):
+        with self.lock:
+            artifacts = self.load()['artifacts']
+            artifacts.pop(key, None)
+            artifacts[key] = url
+            # oldest entries first, so trimming keeps the most recent uploads
+            while len(artifacts) > ARTIFACT_CACHE_SIZE:
+                artifacts.pop(next(iter(artifacts)))
+            self.save()
+
+    def remove_artifact(self, key: str):
+        with self.lock:
+            if self.load()['artifacts'].pop(key, None) is not None:
+                self.save()
+
+    def get_uploads(self) -> Dict[str, Any]:
+        # sessions are written when an upload starts and removed when it
+        # completes, interrupted ones that are never resumed expire here
+        with self.lock:
+            uploads = self.load()['uploads']
+            now = time.time()
+            for expired in [k for k, v in uploads.items() if now - v.get('startedAt', 0) >= UPLOAD_SESSION_TTL]:
+                del uploads[expired]
+            return uploads
+
+    def get_upload(self, key: str) -> Optional[Dict[str, Any]]:
+        return self.get_uploads().get(key)
+
+    def set_upload(self, key: str, session: Dict[str, Any]):
+        with self.lock:
+            self.get_uploads()[key] = dict(session, startedAt=time.time())
+            self.save()
+
+    def remove_upload(self, key: str):
+        with self.lock:
+            self.load()['uploads'].pop(key, None)
+            self.save()
+
+
+cache: Optional[ArtifactCache] = None
+cache_lock = threading.Lock()
+
+
+def get_artifact_cache() -> ArtifactCache:
+    global cache
+    if cache is None:
+        with cache_lock:
+            if cache is None:
+                cache = ArtifactCache()
+    return cache
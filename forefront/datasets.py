@@ -1,17 +1,22 @@
-from tqdm import tqdm
 from .api import API
 from .state import State
+from . import shards
+from .ragged import RaggedArray, as_column
+from .stats import ColumnStats, update_stats
+from . import instrumentation
+from .metadata import get_metadata_cache
 import numpy as np
-import requests
-from typing import Optional, Mapping, NoReturn, Any, List, Union, Tuple, Iterable, Generator
+from typing import Optional, Mapping, NoReturn, Any, List, Union, Tuple, Iterable, Generator, Dict
 import os.path
 from pathlib import Path
-import tarfile
 import os
 import json
-from prettytable import PrettyTable
 import shutil
 
+RAGGED_OFFSETS_SUFFIX = '.offsets.npy'
+SHARD_CACHE_FILENAME = f'shard.{shards.SHARD_EXTENSION}'
+DEFAULT_SHARD_BYTES = 64 * 1024 * 1024
+
 
 def save_tuple_of_numpy_arrays(tuple_of_arrays: Tuple[np.ndarray], index: int, skip_tar: Optional[bool] = False) -> List[str]:
     if not isinstance(tuple_of_arrays, tuple) and not isinstance(tuple_of_arrays, list):
@@ -19,13 +24,19 @@ def save_tuple_of_numpy_arrays(tuple_of_arrays: Tuple[np.ndarray], index: int, s
 
     home_path = os.path.join(Path.home(), '.forefront', 'upload')
 
+    filenames: List[str] = []
     for i, item in enumerate(tuple_of_arrays):
         filename = 'x{}_{}.npy'.format(i, index)
         save_path = os.path.join(home_path, filename)
-        np.save(save_path, item)
+        item = as_column(item)
 
-    filenames = [os.path.join(home_path, 'x{}_{}.npy'.format(
-        i, index)) for i in range(len(tuple_of_arrays))]
+        if isinstance(item, RaggedArray):
+            np.save(save_path, item.values)
+            np.save(ragged_offsets_path(save_path), item.offsets)
+            filenames += [save_path, ragged_offsets_path(save_path)]
+        else:
+            np.save(save_path, item)
+            filenames.append(save_path)
 
     # if not skip_tar:
     #     tar_path = os.path.join(home_path, '{}.tar.gz'.format(index))
@@ -49,20 +60,206 @@ def delete_contents_of_folder(folder: str):
             os.remove(p)
 
 
-def get_data_from_numpy_files(folder: str) -> Tuple[np.ndarray]:
-    result = tuple()
+def parse_numpy_filename(filename: str) -> Tuple[int, int]:
+    # uploaded arrays are named x<column>_<sample>.npy
+    column, sample = filename.split('.')[0][1:].split('_')
+    return int(column), int(sample)
+
+
+def is_selected_column(filename: str, columns: Optional[List[int]] = None) -> bool:
+    if '.npy' not in filename:
+        return False
+    if columns is None:
+        return True
+    return parse_numpy_filename(os.path.basename(filename))[0] in columns
+
+
+def ragged_offsets_path(path: str) -> str:
+    # ragged columns keep their values in x<column>_<sample>.npy and the
+    # int64 offsets into them next to it
+    return path[:-len('.npy')] + RAGGED_OFFSETS_SUFFIX
+
+
+def read_numpy_items(folder: str, columns: Optional[List[int]] = None,
+                     mmap_mode: Optional[str] = None) -> Dict[Tuple[int, int], Any]:
+    items: Dict[Tuple[int, int], Any] = {}
     for file in os.listdir(folder):
-        if '.npy' in file:
+        if is_selected_column(file, columns) and not file.endswith(RAGGED_OFFSETS_SUFFIX):
             p = os.path.join(folder, file)
 
-            data = np.load(p)
+            data = np.load(p, mmap_mode=mmap_mode)
+            if os.path.isfile(ragged_offsets_path(p)):
+                data = RaggedArray(data, np.load(ragged_offsets_path(p)))
 
-            result += (data,)
+            column, sample = parse_numpy_filename(file)
+            items[(sample, column)] = data
 
-    return result
+    return items
+
+
+def get_data_from_numpy_files(folder: str, columns: Optional[List[int]] = None) -> Tuple[Union[np.ndarray, RaggedArray]]:
+    with instrumentation.span('dataset.load', stage='download'):
+        items = read_numpy_items(folder, columns)
+
+    return tuple(items[key] for key in sorted(items))
+
+
+def load_shard_items(folder: str, columns: Optional[List[int]] = None) -> Dict[Tuple[int, int], Any]:
+    # indexed shards are cached as downloaded and memory mapped, legacy tar
+    # shards as extracted .npy files
+    path = os.path.join(folder, SHARD_CACHE_FILENAME)
+    if os.path.isfile(path):
+        return shards.read_shard_items(path, columns)
+    return read_numpy_items(folder, columns, mmap_mode='r')
+
+
+def load_shard(folder: str, columns: Optional[List[int]] = None) -> Tuple[Union[np.ndarray, RaggedArray]]:
+    path = os.path.join(folder, SHARD_CACHE_FILENAME)
+    if not os.path.isfile(path):
+        return get_data_from_numpy_files(folder, columns)
+
+    with instrumentation.span('dataset.load', stage='download'):
+        return shards.read_shard(path, columns)
+
+
+def get_shard_cache_path(dataset_version_id: str, index: int) -> str:
+    # shard indices restart at 0 for every version, so the version is part
+    # of the path, for the extracted arrays and their .columns marker alike
+    return os.path.join(Path.home(), '.forefront', 'data', dataset_version_id, str(index))
+
+
+def get_cached_columns(folder: str) -> Union[List[int], None, bool]:
+    # the columns a cached shard holds, None for all of them and False when
+    # nothing is cached
+    marker = os.path.join(folder, '.columns')
+    if not os.path.isfile(marker):
+        return False
+
+    with open(marker, 'r') as f:
+        return json.load(f)
+
+
+def has_cached_columns(folder: str, columns: Optional[List[int]] = None) -> bool:
+    cached = get_cached_columns(folder)
+    if cached is False:
+        return False
+
+    if cached is None:
+        return True
+    return columns is not None and set(columns).issubset(cached)
+
+
+class PrefixedStream:
+    # puts bytes that were peeked from a stream back in front of it
+    def __init__(self, prefix: bytes, stream: Any):
+        self.prefix = prefix
+        self.stream = stream
+
+    def read(self, size: int = -1) -> bytes:
+        if len(self.prefix) == 0:
+            return self.stream.read(size)
+
+        if size < 0:
+            out, self.prefix = self.prefix + self.stream.read(), b''
+        else:
+            out, self.prefix = self.prefix[:size], self.prefix[size:]
+        return out
+
+
+def read_byte_range(s3_url: str, start: int, end: int) -> bytes:
+    res = instrumentation.request('GET', s3_url, stage='dataset.range',
+                                  headers={'Range': f'bytes={start}-{end - 1}'})
+
+    if res.status_code == 206:
+        return res.content
+    if res.status_code == 200:
+        # the server ignored the range and sent the whole object
+        return res.content[start:end]
+    raise Exception(f'Range request failed with status {res.status_code}')
+
+
+def save_shard_elements(elements: Iterable[Tuple[Any, np.ndarray]], out_folder: str) -> NoReturn:
+    for element, array in elements:
+        path = os.path.join(out_folder, 'x{}_{}.npy'.format(element['column'], element['sample']))
+        if element.get('ragged') == 'offsets':
+            path = ragged_offsets_path(path)
+        np.save(path, array)
+
+
+def write_shard_ranges(path: str, prefix: bytes, header: Any, data_offset: int,
+                       ranges: List[Tuple[int, bytes]]) -> NoReturn:
+    # the cached file keeps the shard's layout with only the selected
+    # columns' blocks filled in, the rest is left as a hole. columns fetched
+    # later are written into the same file
+    mode = 'r+b' if os.path.isfile(path) else 'wb'
+    with open(path, mode) as f:
+        f.write(prefix)
+        for start, data in ranges:
+            f.seek(start)
+            f.write(data)
+        f.truncate(shards.get_shard_size(header, data_offset))
+
+
+def extract_shard(s3_url: str, out_folder: str, columns: Optional[List[int]] = None,
+                  keep_indexed: bool = False) -> NoReturn:
+    import tarfile
+
+    # stream the shard straight from the response, only writing out the
+    # arrays for the selected columns. with keep_indexed an indexed shard is
+    # saved as a file for read_shard instead of being split into .npy files
+    Path(out_folder).mkdir(parents=True, exist_ok=True)
+    cached_columns = columns
+
+    with instrumentation.span('dataset.extract', stage='download'), \
+            instrumentation.request('GET', s3_url, stage='dataset.download', stream=True) as res:
+        res.raw.decode_content = True
+        # time spent blocked on the socket is reported on its own, the rest
+        # of the extract span is decompression, parsing and writing
+        stream = instrumentation.timed_stream(res.raw, 'dataset.network', stage='download')
+        prefix = stream.read(shards.SHARD_PREFIX_SIZE)
+
+        if not shards.is_indexed_shard(prefix):
+            with tarfile.open(fileobj=PrefixedStream(prefix, stream), mode='r|*') as tar:
+                for member in tar:
+                    if member.isfile() and is_selected_column(member.name, columns):
+                        tar.extract(member, out_folder)
+
+        elif columns is None and keep_indexed:
+            with open(os.path.join(out_folder, SHARD_CACHE_FILENAME), 'wb') as f:
+                f.write(prefix)
+                shutil.copyfileobj(stream, f, 1024 * 1024)
+
+        elif columns is None:
+            save_shard_elements(shards.iter_stream_elements(stream, prefix=prefix), out_folder)
+
+        else:
+            # indexed shard with a projection: fetch the header, then only
+            # the byte ranges of the selected columns
+            header_size = shards.get_header_size(prefix)
+            res.close()
+            header_bytes = prefix + read_byte_range(s3_url, shards.SHARD_PREFIX_SIZE, header_size)
+            header, data_offset = shards.parse_header(header_bytes)
+            ranges = [(start, read_byte_range(s3_url, start, end))
+                      for start, end in shards.get_byte_ranges(header, data_offset, columns)]
+
+            if keep_indexed:
+                path = os.path.join(out_folder, SHARD_CACHE_FILENAME)
+                previous = get_cached_columns(out_folder) if os.path.isfile(path) else False
+                write_shard_ranges(path, header_bytes, header, data_offset, ranges)
+                if isinstance(previous, list):
+                    cached_columns = sorted(set(previous) | set(columns))
+            else:
+                save_shard_elements(shards.iter_range_elements(header, data_offset, ranges, columns), out_folder)
+
+        instrumentation.finish_stream(stream)
+
+    with open(os.path.join(out_folder, '.columns'), 'w') as f:
+        json.dump(sorted(cached_columns) if cached_columns is not None else None, f)
 
 
 def decode_tar_path(path: str, index: int, skip_extraction: bool = False) -> Tuple[np.ndarray]:
+    import tarfile
+
     out_folder = os.path.join(Path.home(), '.forefront', 'data')
     with tarfile.open(path) as tar:
         tar.extractall(out_folder)
@@ -73,7 +270,182 @@ def decode_tar_path(path: str, index: int, skip_extraction: bool = False) -> Tup
         return result
 
 
+def shard_indices_for_rank(shard_indices: Iterable[int], rank: int = 0, world_size: int = 1,
+                           worker_id: int = 0, num_workers: int = 1, epoch: int = 0, seed: int = 0) -> List[int]:
+    if world_size < 1 or not 0 <= rank < world_size:
+        raise ValueError('rank must be between 0 and world_size - 1!')
+    if num_workers < 1 or not 0 <= worker_id < num_workers:
+        raise ValueError('worker_id must be between 0 and num_workers - 1!')
+
+    # every participant draws the same permutation for a given epoch, then
+    # takes a strided slice of it so the subsets are disjoint and differ in
+    # size by at most one shard
+    indices = np.array(list(shard_indices), dtype=np.int64)
+    order = np.random.RandomState(seed + epoch).permutation(len(indices))
+    participant = rank * num_workers + worker_id
+    n_participants = world_size * num_workers
+
+    return [int(i) for i in indices[order][participant::n_participants]]
+
+
+def materialize_shards(folders: List[str], path: str, columns: Optional[List[int]] = None,
+                       layout: Optional[str] = 'rows') -> NoReturn:
+    # first pass only looks at the shapes and dtypes of the memory mapped
+    # items to size one output file per column, the second copies each item
+    # into its slice of the memmap
+    Path(path).mkdir(parents=True, exist_ok=True)
+
+    dtypes: Dict[int, np.dtype] = {}
+    ragged: Dict[int, bool] = {}
+    found: Dict[int, List[Tuple[Tuple[int, ...], int]]] = {}
+    for folder in folders:
+        items = load_shard_items(folder, columns)
+        for sample, column in sorted(items):
+            item = items[(sample, column)]
+            is_ragged = isinstance(item, RaggedArray)
+            values = item.values if is_ragged else item
+
+            if column not in dtypes:
+                dtypes[column], ragged[column], found[column] = values.dtype, is_ragged, []
+            elif dtypes[column] != values.dtype or ragged[column] != is_ragged:
+                raise ValueError(f'Column {column} has inconsistent shapes or dtypes across samples!')
+            found[column].append((values.shape, len(item) if is_ragged else 0))
+
+    # items of a 'samples' version are single samples, stacked on a new
+    # leading axis, or kept as one ragged item each when their lengths
+    # differ. items of a 'rows' version are batches and are concatenated
+    wrap: Dict[int, Optional[str]] = {}
+    shapes: Dict[int, Tuple[int, ...]] = {}
+    lengths: Dict[int, List[int]] = {}
+    values_lengths: Dict[int, List[int]] = {}
+    for column, items_found in found.items():
+        item_shapes = [shape for shape, _ in items_found]
+        wrap[column] = None
+        if layout == 'samples' and not ragged[column]:
+            wrap[column] = 'stack' if len(set(item_shapes)) == 1 else 'item'
+
+        if wrap[column] == 'stack':
+            shapes[column] = item_shapes[0]
+            lengths[column] = values_lengths[column] = [1] * len(item_shapes)
+            continue
+
+        if wrap[column] == 'item' and any(len(shape) == 0 for shape in item_shapes):
+            raise ValueError(f'Column {column} mixes scalars and arrays across samples!')
+        item_shapes = [shape if len(shape) > 0 else (1,) for shape in item_shapes]
+        if len(set(shape[1:] for shape in item_shapes)) > 1:
+            raise ValueError(f'Column {column} has inconsistent shapes or dtypes across samples!')
+
+        shapes[column] = item_shapes[0][1:]
+        if wrap[column] == 'item':
+            ragged[column] = True
+            lengths[column] = [1] * len(item_shapes)
+        else:
+            # ragged columns are indexed by item, the values are stored flat
+            lengths[column] = [n if ragged[column] else shape[0]
+                               for shape, (_, n) in zip(item_shapes, items_found)]
+        values_lengths[column] = [shape[0] for shape in item_shapes]
+
+    index: Any = {'columns': []}
+    offsets: Dict[int, np.ndarray] = {}
+    values_offsets: Dict[int, np.ndarray] = {}
+    outputs: Dict[int, np.ndarray] = {}
+    ragged_outputs: Dict[int, np.ndarray] = {}
+    for column in sorted(shapes):
+        offsets[column] = np.concatenate([[0], np.cumsum(lengths[column], dtype=np.int64)])
+        values_offsets[column] = np.concatenate([[0], np.cumsum(values_lengths[column], dtype=np.int64)])
+        shape = (int(values_offsets[column][-1]),) + tuple(shapes[column])
+        filename = f'x{column}.npy'
+        outputs[column] = np.lib.format.open_memmap(os.path.join(path, filename), mode='w+',
+                                                    dtype=dtypes[column], shape=shape)
+        np.save(os.path.join(path, f'x{column}.offsets.npy'), offsets[column])
+        entry = {'column': column, 'file': filename, 'offsets': f'x{column}.offsets.npy',
+                 'dtype': dtypes[column].str, 'shape': list(shape), 'samples': len(lengths[column])}
+
+        if ragged[column]:
+            entry['ragged'] = f'x{column}.ragged.npy'
+            ragged_outputs[column] = np.lib.format.open_memmap(os.path.join(path, entry['ragged']), mode='w+',
+                                                               dtype=np.int64, shape=(int(offsets[column][-1]) + 1,))
+            ragged_outputs[column][0] = 0
+        index['columns'].append(entry)
+
+    positions = {column: 0 for column in shapes}
+    for folder in folders:
+        items = load_shard_items(folder, columns)
+        for sample, column in sorted(items):
+            item = items[(sample, column)]
+            values = item.values if isinstance(item, RaggedArray) else item
+            position = positions[column]
+            start, end = values_offsets[column][position], values_offsets[column][position + 1]
+            outputs[column][start:end] = values.reshape((-1,) + tuple(shapes[column]))
+
+            if ragged[column]:
+                item_offsets = item.offsets if wrap[column] is None else np.array([0, len(values)])
+                ragged_outputs[column][offsets[column][position]:offsets[column][position + 1] + 1] = \
+                    item_offsets + start
+            positions[column] += 1
+
+    for output in list(outputs.values()) + list(ragged_outputs.values()):
+        output.flush()
+
+    with open(os.path.join(path, 'index.json'), 'w') as f:
+        json.dump(index, f)
+
+
+def load_materialized(path: str, columns: Optional[List[int]] = None) -> Tuple[Union[np.ndarray, RaggedArray]]:
+    with open(os.path.join(path, 'index.json'), 'r') as f:
+        index = json.load(f)
+
+    result = tuple()
+    for c in index['columns']:
+        if columns is not None and c['column'] not in columns:
+            continue
+
+        data = np.load(os.path.join(path, c['file']), mmap_mode='r')
+        if 'ragged' in c:
+            data = RaggedArray(data, np.load(os.path.join(path, c['ragged']), mmap_mode='r'))
+        result += (data,)
+
+    return result
+
+
+def get_rows_per_shard(row_bytes: float, shard_bytes: Optional[int] = DEFAULT_SHARD_BYTES) -> int:
+    return max(1, int(shard_bytes // max(row_bytes, 1)))
+
+
+def series_to_numpy(series: Any) -> np.ndarray:
+    import pandas as pd
+
+    if pd.api.types.is_bool_dtype(series.dtype) or pd.api.types.is_numeric_dtype(series.dtype):
+        if series.hasnans and pd.api.types.is_extension_array_dtype(series.dtype):
+            # nullable integer and boolean columns
+            return series.to_numpy(dtype=np.float64, na_value=np.nan)
+        return series.to_numpy()
+
+    if pd.api.types.is_datetime64_any_dtype(series.dtype):
+        return series.to_numpy(dtype='datetime64[ns]')
+
+    # strings, categories and other python objects are stored as fixed
+    # width unicode so they never need to be pickled
+    return objects_to_strings(series.to_numpy(dtype=object), series.isna().to_numpy())
+
+
+def objects_to_strings(values: np.ndarray, is_null: np.ndarray) -> np.ndarray:
+    # fixed width unicode has no null, so missing values are stored as the
+    # empty string, the way missing floats are stored as nan
+    strings = [('' if null else str(v)) for v, null in zip(values.tolist(), is_null.tolist())]
+    return np.array(strings, dtype=str)
+
+
+def arrow_column_to_numpy(column: Any) -> np.ndarray:
+    array = column.to_numpy(zero_copy_only=False)
+    if array.dtype == object:
+        return objects_to_strings(array, column.is_null().to_numpy(zero_copy_only=False))
+    return array
+
+
 def group_tars(paths: List[str], out_path: str) -> str:
+    import tarfile
+
     home_path = os.path.join(Path.home(), '.forefront', 'upload')
     tar_path = out_path#os.path.join(home_path, out_path)
     with tarfile.open(tar_path, 'w|gz') as f:
@@ -93,9 +465,10 @@ class Datasets:
     state: State
     api: API
     project_id: str
+    dataset_ids: Dict[str, str]
 
-    def __init__(self):
-        self.state = State()
+    def __init__(self, state: Optional[State] = None):
+        self.state = state if state is not None else State()
 
         self.key = self.state.get_token()
         self.project_id = self.state.get_project_id()
@@ -104,6 +477,7 @@ class Datasets:
         self.tag_endpoint = self.base_endpoint + '/datasets/tags'
 
         self.default_dataset = self.state.get_default_dataset()
+        self.dataset_ids = {}
 
     def set_default_dataset(self, dataset: str):
         if dataset == self.default_dataset:
@@ -112,7 +486,8 @@ class Datasets:
             self.state.set_default_dataset(dataset)
             self.default_dataset = dataset
             data_path = os.path.join(Path.home(), '.forefront', 'data')
-            delete_contents_of_folder(data_path)
+            if os.path.isdir(data_path):
+                delete_contents_of_folder(data_path)
 
     def make_endpoint(self, name: str) -> str:
         return f'{self.base_endpoint}/{self.endpoints[name]}'
@@ -120,11 +495,84 @@ class Datasets:
     def make_upload_data_endpoint(self, dataset_id: str, dataset_version_id: str):
         return f'{self.base_endpoint}/datasets/{dataset_id}/versions/{dataset_version_id}/data'
 
+    def make_dataset_version_endpoint(self, dataset_id: str, dataset_version_id: str) -> str:
+        return f'{self.base_endpoint}/datasets/{dataset_id}/versions/{dataset_version_id}'
+
+    def get_manifest(self, dataset_id: str, dataset_version_id: str) -> Any:
+        res = instrumentation.request('GET', self.make_dataset_version_endpoint(dataset_id, dataset_version_id),
+                                      stage='dataset.manifest', headers={'Authorization': self.key})
+
+        if res.status_code != 200:
+            return {}
+        return res.json().get('manifest') or {}
+
+    def set_manifest(self, dataset_id: str, dataset_version_id: str, manifest: Any) -> NoReturn:
+        res = instrumentation.request('PATCH', self.make_dataset_version_endpoint(dataset_id, dataset_version_id),
+                                      stage='dataset.manifest', json={'manifest': manifest},
+                                      headers={'Authorization': self.key})
+
+        if res.status_code != 200:
+            print(f'Unable to save the dataset manifest (status {res.status_code})')
+
+    def get_dataset_stats(self, dataset_version_id: str = None, dataset_id: Optional[str] = None) -> List[Any]:
+        if dataset_version_id is None:
+            raise ValueError('Must include a dataset version id! Get one from your dashboard.')
+
+        dataset_version_id = dataset_version_id.replace('version_', '')
+        if dataset_id is None:
+            dataset_id = self.get_dataset_id_from_dataset_version_id(dataset_version_id)
+
+        manifest = self.get_manifest(dataset_id, dataset_version_id)
+        if 'stats' not in manifest:
+            raise Exception('No statistics were stored for this dataset version. Re-upload it to compute them.')
+
+        return manifest['stats']
+
+    def get_shard_url(self, dataset_id: str, dataset_version_id: str, index: int) -> Optional[str]:
+        endpoint = f'{self.make_upload_data_endpoint(dataset_id, dataset_version_id)}/{index}'
+        res = instrumentation.request('GET', endpoint, stage='dataset.shard_url',
+                                      headers={'Authorization': self.key})
+
+        if res.status_code != 200:
+            return None
+        return res.json()['url']
+
+    def get_shard_indices(self, dataset_id: str, dataset_version_id: str) -> List[int]:
+        # shards are numbered contiguously, so find the first index and then
+        # the end of the run with an exponential + binary search instead of
+        # walking every shard
+        if self.get_shard_url(dataset_id, dataset_version_id, 0) is not None:
+            first = 0
+        elif self.get_shard_url(dataset_id, dataset_version_id, 1) is not None:
+            first = 1
+        else:
+            return []
+
+        manifest = self.get_manifest(dataset_id, dataset_version_id)
+        if 'shards' in manifest:
+            return list(range(first, first + manifest['shards']))
+
+        lo, step = first, 1
+        while self.get_shard_url(dataset_id, dataset_version_id, lo + step) is not None:
+            lo += step
+            step *= 2
+        hi = lo + step
+
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if self.get_shard_url(dataset_id, dataset_version_id, mid) is not None:
+                lo = mid
+            else:
+                hi = mid
+
+        return list(range(first, lo + 1))
+
     def upload_data(self, file_path: str, dataset: str, dataset_version: str) -> str:
         try:
-            response = requests.post(self.make_upload_data_endpoint(dataset, dataset_version),
-                                     headers={'Authorization': self.key},
-                                     files={'file': open(file_path, 'rb')})
+            with open(file_path, 'rb') as f:
+                response = instrumentation.request('POST', self.make_upload_data_endpoint(dataset, dataset_version),
+                                                   stage='dataset.upload', headers={'Authorization': self.key},
+                                                   files={'file': f})
             url: str = response.json()['file']
             return url
 
@@ -139,14 +587,48 @@ class Datasets:
         data_dir = os.path.join(root_path, 'data')
         tar_dir = os.path.join(root_path, 'tar')
 
-        shutil.rmtree(data_dir)
-        shutil.rmtree(tar_dir)
+        shutil.rmtree(data_dir, ignore_errors=True)
+        shutil.rmtree(tar_dir, ignore_errors=True)
 
         Path(data_dir).mkdir(parents=True, exist_ok=True)
         Path(tar_dir).mkdir(parents=True, exist_ok=True)
 
-    def upload(self, name, description, dataloader: Iterable[Tuple[np.ndarray]],
-                          dataset: Optional[str] = None, upload_batch: Optional[int] = 32, tag: Optional[str] = None):
+    def upload_shard(self, samples: List[Tuple[int, Tuple[np.ndarray]]], idx: int, dataset: str,
+                     dataset_version: str, shard_format: Optional[str] = 'indexed',
+                     compress: Optional[bool] = False, stats: Optional[List[ColumnStats]] = None,
+                     layout: Optional[str] = 'rows') -> str:
+        upload_folder = os.path.join(Path.home(), '.forefront', 'upload')
+        Path(upload_folder).mkdir(parents=True, exist_ok=True)
+
+        if stats is not None:
+            with instrumentation.span('dataset.stats', stage='upload'):
+                for _, data in samples:
+                    update_stats(stats, data, sample=layout != 'rows')
+
+        with instrumentation.span('dataset.serialize', stage='upload') as span:
+            if shard_format == 'indexed':
+                single_path = os.path.join(upload_folder, f'{idx}.{shards.SHARD_EXTENSION}')
+                single_path = shards.write_shard(single_path, samples, compress=compress)
+            elif shard_format == 'tar':
+                paths: List[str] = []
+                for i, data in samples:
+                    paths += save_tuple_of_numpy_arrays(data, i)
+                single_path = os.path.join(upload_folder, f'{idx}.tar.gz')
+                single_path = group_tars(paths, single_path)
+                # the arrays are in the archive now
+                for path in paths:
+                    os.remove(path)
+            else:
+                raise ValueError("shard_format must be either 'indexed' or 'tar'")
+            span.set(bytes_written=os.path.getsize(single_path))
+
+        url = self.upload_data(single_path, dataset, dataset_version)
+        os.remove(single_path)
+
+        return url
+
+    def create_dataset_version(self, name, description, dataset: Optional[str] = None,
+                               tag: Optional[str] = None) -> Tuple[str, str]:
 
         self.reset_deta_folders()
 
@@ -166,78 +648,258 @@ class Datasets:
         else:
             data = {'name': name, 'description': description, 'orgId': self.state.get_org_id()}
 
-        response = requests.post(dataset_version_url, json=data, headers={'Authorization': self.key})
+        response = instrumentation.request('POST', dataset_version_url, stage='dataset.create_version', json=data,
+                                           headers={'Authorization': self.key})
 
         dataset_version = response.json()['datasetVersionId']
-        paths: List[str] = []
-        for i, data in enumerate(tqdm(dataloader)):
-            # first save iterable to local
-            path: List[str] = save_tuple_of_numpy_arrays(data, i)
-            for p in path:
-                paths.append(p)
-            # then upload
-            if (i + 1) % upload_batch == 0:
-                idx = (i + 1) // upload_batch
-                single_path = os.path.join(Path.home(), '.forefront', 'upload', f'{idx}.tar.gz')
-                single_path = group_tars(paths, single_path)
-                url = self.upload_data(single_path, dataset, dataset_version)
-                paths = []
+        self.dataset_ids[dataset_version] = dataset
+        get_metadata_cache().invalidate(dataset_version_url)
+        get_metadata_cache().set_id('dataset_version', dataset_version, dataset)
+        return dataset, dataset_version
+
+    def finish_upload(self, dataset: str, dataset_version: str, shard_format: str, n_shards: int,
+                      n_samples: int, stats: List[ColumnStats], layout: Optional[str] = None) -> NoReturn:
+        manifest: Any = {
+            'format': shard_format,
+            'shards': n_shards,
+            'samples': n_samples,
+        }
+        # whether every item is a single sample ('samples', from upload) or a
+        # batch of rows ('rows', from upload_columns)
+        if layout is not None:
+            manifest['layout'] = layout
+        if len(stats) > 0 or n_samples == 0:
+            manifest['stats'] = [s.to_dict() for s in stats]
+
+        self.set_manifest(dataset, dataset_version, manifest)
+
+    def upload(self, name, description, dataloader: Iterable[Tuple[np.ndarray]],
+                          dataset: Optional[str] = None, upload_batch: Optional[int] = 32, tag: Optional[str] = None,
+                          shard_format: Optional[str] = 'indexed', compress: Optional[bool] = False) -> str:
+
+        dataset, dataset_version = self.create_dataset_version(name, description, dataset, tag)
+
+        stats: List[ColumnStats] = []
+        n_shards, n_samples = self.upload_samples(dataloader, dataset, dataset_version, upload_batch,
+                                                  shard_format, compress, stats)
+
+        self.finish_upload(dataset, dataset_version, shard_format, n_shards, n_samples, stats, 'samples')
+
+        return dataset_version
 
-    def get_dataloader(self, dataset_version_id: Optional[str] = None):
+    def upload_samples(self, dataloader: Iterable[Tuple[np.ndarray]], dataset: str, dataset_version: str,
+                       upload_batch: Optional[int] = 32, shard_format: Optional[str] = 'indexed',
+                       compress: Optional[bool] = False, stats: Optional[List[ColumnStats]] = None,
+                       first_shard: int = 0, first_sample: int = 0,
+                       layout: Optional[str] = 'samples') -> Tuple[int, int]:
+        from tqdm import tqdm
+
+        samples: List[Tuple[int, Tuple[np.ndarray]]] = []
+        idx = first_shard
+        n_samples = 0
+        for i, data in enumerate(tqdm(dataloader), start=first_sample):
+            samples.append((i, data))
+            n_samples += 1
+            if len(samples) == upload_batch:
+                idx += 1
+                self.upload_shard(samples, idx, dataset, dataset_version, shard_format, compress, stats, layout)
+                samples = []
+
+        if len(samples) > 0:
+            idx += 1
+            self.upload_shard(samples, idx, dataset, dataset_version, shard_format, compress, stats, layout)
+
+        return idx - first_shard, n_samples
+
+    def get_next_sample_index(self, dataset_id: str, dataset_version_id: str, index: int) -> int:
+        # versions uploaded before manifests existed only record sample
+        # numbers in the shards themselves, so look at the last one
+        folder = os.path.join(Path.home(), '.forefront', 'tar', f'last-{dataset_version_id}')
+        extract_shard(self.get_shard_url(dataset_id, dataset_version_id, index), folder, [0])
+
+        samples = [parse_numpy_filename(f)[1] for f in os.listdir(folder) if is_selected_column(f)]
+        shutil.rmtree(folder)
+
+        return max(samples) + 1 if len(samples) > 0 else 0
+
+    def append(self, dataset_version_id: str, dataloader: Iterable[Tuple[np.ndarray]],
+               upload_batch: Optional[int] = 32, dataset_id: Optional[str] = None,
+               compress: Optional[bool] = False) -> str:
+        if dataset_version_id is None:
+            raise ValueError('Must include a dataset version id! Get one from your dashboard.')
+
+        dataset_version_id = dataset_version_id.replace('version_', '')
+        if dataset_id is None:
+            dataset_id = self.get_dataset_id_from_dataset_version_id(dataset_version_id)
+
+        manifest = self.get_manifest(dataset_id, dataset_version_id)
+        if 'shards' in manifest and 'samples' in manifest:
+            n_shards, n_samples = manifest['shards'], manifest['samples']
+        else:
+            indices = self.get_shard_indices(dataset_id, dataset_version_id)
+            n_shards = len(indices)
+            n_samples = self.get_next_sample_index(dataset_id, dataset_version_id, indices[-1]) if n_shards else 0
+
+        shard_format = manifest.get('format', 'indexed')
+        stats = [ColumnStats.from_dict(s) for s in manifest.get('stats', [])]
+        has_stats = 'stats' in manifest or n_shards == 0
+
+        # new shards are posted after the existing ones, so /data/<i> keeps
+        # counting up from the last shard, and sample numbers keep counting
+        # up so cached x<column>_<sample>.npy names never collide
+        new_shards, new_samples = self.upload_samples(dataloader, dataset_id, dataset_version_id, upload_batch,
+                                                      shard_format, compress, stats, n_shards, n_samples,
+                                                      manifest.get('layout'))
+
+        if not has_stats:
+            # statistics of the earlier shards are unknown, so don't publish
+            # numbers that only describe the delta
+            stats = []
+        self.finish_upload(dataset_id, dataset_version_id, shard_format, n_shards + new_shards,
+                           n_samples + new_samples, stats, manifest.get('layout'))
+        print(f'Appended {new_samples} samples in {new_shards} shards')
+
+        return dataset_version_id
+
+    def upload_columns(self, name, description, batches: Iterable[Tuple[np.ndarray]],
+                       dataset: Optional[str] = None, tag: Optional[str] = None,
+                       shard_format: Optional[str] = 'indexed', compress: Optional[bool] = False) -> str:
+        from tqdm import tqdm
+
+        # every batch is a tuple of column slices and becomes its own shard
+        dataset, dataset_version = self.create_dataset_version(name, description, dataset, tag)
+
+        stats: List[ColumnStats] = []
+        n_shards = 0
+        for idx, batch in enumerate(tqdm(batches)):
+            self.upload_shard([(idx, batch)], idx + 1, dataset, dataset_version, shard_format, compress, stats)
+            n_shards += 1
+
+        self.finish_upload(dataset, dataset_version, shard_format, n_shards, n_shards, stats, 'rows')
+
+        return dataset_version
+
+    def upload_dataframe(self, df: Any, name, description, dataset: Optional[str] = None,
+                         columns: Optional[List[str]] = None, shard_bytes: Optional[int] = DEFAULT_SHARD_BYTES,
+                         tag: Optional[str] = None, shard_format: Optional[str] = 'indexed',
+                         compress: Optional[bool] = False) -> str:
+        if columns is None:
+            columns = list(df.columns)
+
+        arrays = [series_to_numpy(df[c]) for c in columns]
+
+        print(f"Uploading columns {columns} as tuple elements 0 to {len(columns) - 1}")
+
+        return self.upload_arrays(*arrays, name=name, description=description, dataset=dataset,
+                                  shard_bytes=shard_bytes, tag=tag, shard_format=shard_format, compress=compress)
+
+    def upload_arrays(self, *arrays: Union[np.ndarray, RaggedArray], name, description=None,
+                      dataset: Optional[str] = None, shard_rows: Optional[int] = None,
+                      shard_bytes: Optional[int] = None, tag: Optional[str] = None,
+                      shard_format: Optional[str] = 'indexed', compress: Optional[bool] = False) -> str:
+        if len(arrays) == 0:
+            raise ValueError('Must include at least one array to upload!')
+        if shard_rows is not None and shard_bytes is not None:
+            raise ValueError('Specify either shard_rows or shard_bytes, not both!')
+
+        n_rows = len(arrays[0])
+        if any(len(a) != n_rows for a in arrays):
+            raise ValueError('All arrays must have the same length along axis 0! Got lengths {}'.format(
+                [len(a) for a in arrays]))
+
+        if shard_rows is None:
+            row_bytes = sum(a.nbytes for a in arrays) / max(n_rows, 1)
+            shard_rows = get_rows_per_shard(row_bytes, shard_bytes or DEFAULT_SHARD_BYTES)
+
+        # basic slices are views, so for C-contiguous (including np.memmap)
+        # input each shard is written to disk straight from the source pages
+        batches = (tuple(a[start:start + shard_rows] for a in arrays) for start in range(0, n_rows, shard_rows))
+        return self.upload_columns(name, description, batches, dataset, tag, shard_format, compress)
+
+    def upload_arrow(self, table: Any, name, description, dataset: Optional[str] = None,
+                     columns: Optional[List[str]] = None, shard_bytes: Optional[int] = DEFAULT_SHARD_BYTES,
+                     tag: Optional[str] = None, shard_format: Optional[str] = 'indexed',
+                     compress: Optional[bool] = False) -> str:
+        if columns is None:
+            columns = list(table.column_names)
+
+        table = table.select(columns)
+        rows = get_rows_per_shard(table.nbytes / max(table.num_rows, 1), shard_bytes)
+
+        print(f"Uploading columns {columns} as tuple elements 0 to {len(columns) - 1}")
+
+        batches = (tuple(arrow_column_to_numpy(c) for c in batch.columns)
+                   for batch in table.to_batches(max_chunksize=rows))
+        return self.upload_columns(name, description, batches, dataset, tag, shard_format, compress)
+
+    def upload_parquet(self, path: str, name, description, dataset: Optional[str] = None,
+                       columns: Optional[List[str]] = None, shard_bytes: Optional[int] = DEFAULT_SHARD_BYTES,
+                       tag: Optional[str] = None, shard_format: Optional[str] = 'indexed',
+                       compress: Optional[bool] = False) -> str:
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('You must have pyarrow installed to upload parquet files! pip install forefront[arrow]')
+
+        f = pq.ParquetFile(path)
+        if columns is None:
+            columns = list(f.schema_arrow.names)
+
+        # size shards from the uncompressed row group sizes without reading
+        # any data, then stream the file one shard at a time
+        metadata = f.metadata
+        total_bytes = sum(metadata.row_group(i).total_byte_size for i in range(metadata.num_row_groups))
+        total_bytes *= len(columns) / max(metadata.num_columns, 1)
+        rows = get_rows_per_shard(total_bytes / max(metadata.num_rows, 1), shard_bytes)
+
+        print(f"Uploading columns {columns} as tuple elements 0 to {len(columns) - 1}")
+
+        batches = (tuple(arrow_column_to_numpy(c) for c in batch.columns)
+                   for batch in f.iter_batches(batch_size=rows, columns=columns))
+        return self.upload_columns(name, description, batches, dataset, tag, shard_format, compress)
+
+    def get_dataloader(self, dataset_version_id: Optional[str] = None, rank: int = 0, world_size: int = 1,
+                       worker_id: int = 0, num_workers: int = 1, epoch: int = 0, seed: int = 0,
+                       columns: Optional[List[int]] = None):
 
         if dataset_version_id is None:
             raise ValueError(
                 'Must include a dataset version ID! Get yours from the dashboard.')
 
         dataset_version_id = dataset_version_id.replace('version_', '')
+        is_sharded = world_size > 1 or num_workers > 1
 
         def loader():
 
-            i = 0
-            has_more = True
-
-            while has_more:
-
-                save_path = os.path.join(
-                    Path.home(), '.forefront', 'data', str(i))
-                l = os.listdir(save_path) if os.path.isdir(save_path) else []
-                files = [f for f in l if '.npy' in f]
+            dataset_id = self.get_dataset_id_from_dataset_version_id(
+                dataset_version_id)
 
-                if len(files) > 0:
-                    yield get_data_from_numpy_files(save_path)
-                    i += 1
-                    continue
+            # the same index source in both modes, like quick_download_dataset
+            shard_indices = self.get_shard_indices(dataset_id, dataset_version_id)
+            if is_sharded:
+                shard_indices = shard_indices_for_rank(
+                    shard_indices, rank=rank, world_size=world_size, worker_id=worker_id,
+                    num_workers=num_workers, epoch=epoch, seed=seed)
 
-                dataset_id = self.get_dataset_id_from_dataset_version_id(
-                    dataset_version_id)
-                base = self.make_upload_data_endpoint(
-                    dataset_id, dataset_version_id)
-                endpoint = f'{base}/{i}'
-                res = requests.get(endpoint, headers={
-                    'Authorization': self.key})
+            for i in shard_indices:
 
-                if res.status_code != 200:
-                    has_more = False
-                    print('Finished getting data!')
-                    break
+                save_path = get_shard_cache_path(dataset_version_id, i)
 
-                tar_folder = os.path.join(Path.home(), '.forefront', 'tar')
+                if has_cached_columns(save_path, columns):
+                    yield load_shard(save_path, columns)
+                    continue
 
-                if not os.path.isdir(tar_folder):
-                    os.mkdir(tar_folder)
-                s3_url = res.json()['url']
-                data_res = requests.get(s3_url)
+                s3_url = self.get_shard_url(dataset_id, dataset_version_id, i)
 
-                tar_save_path = os.path.join(
-                    Path.home(), '.forefront', 'tar', f'{i}.tar.gz')
-                with open(tar_save_path, 'wb') as f:
-                    f.write(data_res.content)
+                if s3_url is None:
+                    continue
 
-                data = decode_tar_path(tar_save_path, i)
+                extract_shard(s3_url, save_path, columns, keep_indexed=True)
 
-                yield data
+                yield load_shard(save_path, columns)
 
-                i += 1
+            if not is_sharded:
+                print('Finished getting data!')
 
         return loader
 
@@ -245,16 +907,23 @@ class Datasets:
         datasets_url = self.base_endpoint + '/datasets'
         self.reset_deta_folders()
         data = {'name': name, 'description': description, 'orgId': orgId}
-        response = requests.post(datasets_url, json=data, headers={
-            'Authorization': self.key})
+        response = instrumentation.request('POST', datasets_url, stage='dataset.create', json=data,
+                                           headers={'Authorization': self.key})
+        get_metadata_cache().invalidate(datasets_url)
         return response.status_code
 
+    def get_datasets(self, refresh: bool = False) -> List[Any]:
+        return get_metadata_cache().get(self.base_endpoint + '/datasets', self.key, stage='dataset.list',
+                                        refresh=refresh)
+
+    def get_dataset_versions(self, dataset_id: str, refresh: bool = False) -> List[Any]:
+        return get_metadata_cache().get(self.base_endpoint + '/datasets/' + dataset_id + '/versions', self.key,
+                                        stage='dataset.list', refresh=refresh)
+
     def list_datasets(self):
-        datasets_url = self.base_endpoint + '/datasets'
+        from prettytable import PrettyTable
 
-        res = requests.get(datasets_url, headers={
-            'Authorization': self.key})
-        data = res.json()
+        data = self.get_datasets()
         t = PrettyTable(['id', 'name', 'created_at'])
 
         for d in data:
@@ -265,6 +934,7 @@ class Datasets:
         return print(t)
 
     def list_dataset_versions(self, dataset: Optional[str] = None):
+        from prettytable import PrettyTable
 
         if not dataset:
             if self.default_dataset is not None:
@@ -275,10 +945,7 @@ class Datasets:
                     'Dataset not specified, and no  default dataset was found. Please specify a datset.')
                 return
 
-        datasets_url = self.base_endpoint + '/datasets/' + dataset + '/versions'
-        res = requests.get(datasets_url, headers={
-            'Authorization': self.key})
-        data = res.json()
+        data = self.get_dataset_versions(dataset)
 
         t = PrettyTable(['id', 'datasetId', 'name',
                          'description', 'createdAt'])
@@ -290,65 +957,91 @@ class Datasets:
         return
 
     def get_dataset_id_from_dataset_version_id(self, dataset_version_id: str) -> str:
-        datasets_url = self.base_endpoint + '/datasets'
-        response = requests.get(datasets_url, headers={
-            'Authorization': self.key})
+        dataset_version_id = dataset_version_id.replace('version_', '')
+        if dataset_version_id in self.dataset_ids:
+            return self.dataset_ids[dataset_version_id]
+
+        # a version never moves between datasets, so a resolved id is kept
+        # for good
+        cache = get_metadata_cache()
+        dataset_id = cache.get_id('dataset_version', dataset_version_id)
+        if dataset_id is not None:
+            self.dataset_ids[dataset_version_id] = dataset_id
+            return dataset_id
+
+        # cached listings first, then once more with fresh ones in case the
+        # version is newer than the cache
+        for refresh in [False, True]:
+            try:
+                for d in self.get_datasets(refresh=refresh):
+                    for version in self.get_dataset_versions(d['_id'], refresh=refresh):
+                        if version['_id'] == dataset_version_id:
+                            self.dataset_ids[dataset_version_id] = d['_id']
+                            cache.set_id('dataset_version', dataset_version_id, d['_id'])
+                            return d['_id']
+
+            except:
+                pass
 
-        datasets = response.json()
+        return ''
 
-        try:
-            for d in datasets:
-                dataset_id = d['_id']
+    def quick_download_dataset(self, dataset_version_id: str = None, rank: int = 0, world_size: int = 1,
+                               worker_id: int = 0, num_workers: int = 1, epoch: int = 0, seed: int = 0,
+                               columns: Optional[List[int]] = None):
+        from tqdm import tqdm
+
+        if dataset_version_id is None:
+            raise ValueError('Must include a dataset version id! Get one from your dashboard.')
 
-                datasets_url = self.base_endpoint + '/datasets/' + dataset_id + '/versions'
-                versions_response = requests.get(datasets_url, headers={
-                    'Authorization': self.key})
+        dataset_id = self.get_dataset_id_from_dataset_version_id(
+            dataset_version_id)
 
-                versions = versions_response.json()
+        # the same index source in both modes, so the ranks' subsets add up
+        # to exactly the shards a single process downloads
+        shard_indices = self.get_shard_indices(dataset_id, dataset_version_id)
+        if world_size > 1 or num_workers > 1:
+            shard_indices = shard_indices_for_rank(
+                shard_indices, rank=rank, world_size=world_size, worker_id=worker_id,
+                num_workers=num_workers, epoch=epoch, seed=seed)
 
-                for version in versions:
-                    if version['_id'] == dataset_version_id.replace('version_', ''):
-                        return dataset_id
+        data_folder = os.path.join(Path.home(), '.forefront', 'data')
 
-        except:
-            pass
+        for i in tqdm(shard_indices):
+            s3_url = self.get_shard_url(dataset_id, dataset_version_id, i)
+            if s3_url is not None:
+                extract_shard(s3_url, data_folder, columns)
 
-        return ''
+        print('Finished getting data!')
+
+    def materialize(self, dataset_version_id: str = None, path: Optional[str] = None,
+                    columns: Optional[List[int]] = None) -> Tuple[np.ndarray]:
+        from tqdm import tqdm
 
-    def quick_download_dataset(self, dataset_version_id: str = None):
         if dataset_version_id is None:
             raise ValueError('Must include a dataset version id! Get one from your dashboard.')
 
-        i = 1
-        pbar = tqdm()
-        while True:
-            dataset_id = self.get_dataset_id_from_dataset_version_id(
-                dataset_version_id)
-            base = self.make_upload_data_endpoint(
-                dataset_id, dataset_version_id)
-            endpoint = f'{base}/{i}'
-            res = requests.get(endpoint, headers={
-                'Authorization': self.key})
+        dataset_version_id = dataset_version_id.replace('version_', '')
+        if path is None:
+            path = os.path.join(Path.home(), '.forefront', 'materialized', dataset_version_id)
 
-            if res.status_code != 200:
-                print('Finished getting data!')
-                break
+        dataset_id = self.get_dataset_id_from_dataset_version_id(
+            dataset_version_id)
+
+        folders: List[str] = []
+        for i in tqdm(self.get_shard_indices(dataset_id, dataset_version_id)):
+            save_path = get_shard_cache_path(dataset_version_id, i)
 
-            tar_folder = os.path.join(Path.home(), '.forefront', 'tar')
-            if not os.path.isdir(tar_folder):
-                os.mkdir(tar_folder)
-            s3_url = res.json()['url']
-            data_res = requests.get(s3_url)
+            if not has_cached_columns(save_path, columns):
+                extract_shard(self.get_shard_url(dataset_id, dataset_version_id, i), save_path, columns,
+                              keep_indexed=True)
+            folders.append(save_path)
 
-            tar_save_path = os.path.join(
-                Path.home(), '.forefront', 'tar', f'{i}.tar.gz')
-            with open(tar_save_path, 'wb') as f:
-                f.write(data_res.content)
-            decode_tar_path(tar_save_path, i, skip_extraction=True)
-            i += 1
-            pbar.update(1)
+        # versions from before the layout was recorded are concatenated
+        layout = self.get_manifest(dataset_id, dataset_version_id).get('layout', 'rows')
+        materialize_shards(folders, path, columns, layout)
+        print(f'Materialized dataset version to {path}')
 
-        pbar.close()
+        return load_materialized(path)
 
     def get_pytorch_dataset(self, dataset_version_id: Optional[str] = None, skip_download: Optional[bool] = False, tag: Optional[str] = None) -> Any:
 
@@ -356,7 +1049,7 @@ class Datasets:
             from forefront_pytorch import ForefrontDataset
 
             if tag is not None:
-                res = requests.post(self.tag_endpoint, json={'tag': tag}, headers={
+                res = instrumentation.request('POST', self.tag_endpoint, stage='dataset.tag', json={'tag': tag}, headers={
                     'Authorization': self.key
                 })
 
@@ -1,50 +1,16 @@
-import numpy as np
-import requests
-import tempfile
 import os
-import random
-from typing import List, Any, Optional, NoReturn, Union, Iterable
+from typing import List, Any, Optional, NoReturn, Union, Iterable, Tuple
 from .api import API
 from .state import State
 from .datasets import Datasets
+from .inference import predict
 import inspect
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from prettytable import PrettyTable
 
-
-def predict(endpoint: str, data: Any, key: str) -> Any:
-    if endpoint is None:
-        raise Exception('Must include and endpoint')
-    if data is None:
-        raise Exception('Must include data to call endpoint with!')
-    if not isinstance(data, np.ndarray):
-        raise Exception('Data must be a numpy.ndarray')
-
-    directory = tempfile.gettempdir()
-    path = os.path.join(directory, f'{random.randint(10000, 100000)}.npy')
-    np.save(path, data)
-
-    files = {'model_file': open(path, 'rb')}
-    res = requests.post(endpoint, files=files, headers={
-        'authorization': f"Bearer {key}"
-    })
-
-    os.remove(path)
-
-    if (res.status_code == 404):
-        raise Exception('Endpoint is down!')
-
-    if (res.status_code == 401):
-        raise Exception('Your authentication is wrong!')
-
-    if (res.status_code != 200):
-        print(res.text)
-        raise Exception('Something went wrong with the request!')
-
-    try:
-        return res.json()
-    except Exception:
-        raise Exception('Endpoint response is malformed!')
+# background deploys running at once, each one also uploads its artifacts
+# over several connections
+DEPLOY_WORKERS = 4
 
 
 class Forefront:
@@ -55,9 +21,10 @@ class Forefront:
     api: API
     state: State
     datasets: Datasets
+    deploy_executor: Optional[ThreadPoolExecutor]
 
     def __init__(self, init_token: str = ''):
-        self.ensure_all_forefront_dirs()
+        self.deploy_executor = None
         self.state = State()
         token = self.state.get_token()
 
@@ -65,20 +32,18 @@ class Forefront:
 
             if init_token != '':
                 self.state.set_token(init_token)
-                print('Token saved successfully')
-                self.key = self.state.get_token()
-                return
-
-            input_token = input('Please input token: ')
-
-            self.state.set_token(input_token)
+            else:
+                input_token = input('Please input token: ')
+                self.state.set_token(input_token)
             print('Token saved successfully')
 
         self.key = self.state.get_token()
-        self.datasets = Datasets()
+        self.datasets = Datasets(state=self.state)
 
     @staticmethod
     def ensure_all_forefront_dirs():
+        # created on first use rather than in __init__, so a client configured
+        # from the environment never touches the home directory
         root_path = os.path.join(Path.home(), '.forefront')
         Path(root_path).mkdir(parents=True, exist_ok=True)
         Path(os.path.join(root_path, 'data')).mkdir(parents=True, exist_ok=True)
@@ -89,7 +54,7 @@ class Forefront:
     def init(self, project_id: Optional[str] = None, project_name: Optional[str] = None,
              project_description: Optional[str] = None, organization_id: Optional[str] = None, ) -> NoReturn:
         if not isinstance(project_id, str) and not isinstance(project_name, str):
-            self.api = API(self.key, '', '')
+            self.api = API(self.key, '', '', state=self.state)
             projects: List[Any] = self.api.get_projects()
 
             out = ['(0) \t Create a new project - (new) ']
@@ -130,15 +95,15 @@ class Forefront:
                         "Can't find that project. Are you sure you entered it correctly?")
                 self.state.set_project_id(filtered_projects[0]['_id'])
                 self.state.set_org_id(filtered_projects[0]['orgId'])
-            self.api = API(self.key, self.state.get_project_id())
+            self.api = API(self.key, self.state.get_project_id(), state=self.state)
             self.project_id = self.state.get_project_id()
             self.organization_id = self.state.get_org_id()
-            self.datasets = Datasets()
+            self.datasets = Datasets(state=self.state)
             return
 
         if isinstance(project_id, str):
             self.project_id = project_id
-            self.api = API(key=self.key, project_id=project_id)
+            self.api = API(key=self.key, project_id=project_id, state=self.state)
             print('Using the project specified')
 
             return
@@ -151,7 +116,7 @@ class Forefront:
         if isinstance(organization_id, str):
             print('Project will be associated with organization')
             self.api = API(key=self.key, project_id='',
-                           organization_id=organization_id)
+                           organization_id=organization_id, state=self.state)
 
             created_project_id = self.api.create_project(
                 name=project_name, description=project_description)
@@ -160,7 +125,7 @@ class Forefront:
 
         else:
 
-            self.api = API(key=self.key, project_id='')
+            self.api = API(key=self.key, project_id='', state=self.state)
 
             created_project_id = self.api.create_project(
                 name=project_name, description=project_description)
@@ -172,18 +137,21 @@ class Forefront:
             if project_id is None:
                 project_id = self.project_id
 
-            versions = self.api.get_versions()
+            from prettytable import PrettyTable
+
+            versions = self.api.get_versions(project_id)
             t = PrettyTable(['title', 'id', 'url', 'is_custom', 'created_at'])
             for v in versions:
-                if v['endpointId'] == project_id:
-                    t.add_row([v['title'], v['_id'], v['endpointUrl'],
-                               v['isCustom'], v['createdAt']])
+                t.add_row([v['title'], v['_id'], v['endpointUrl'],
+                           v['isCustom'], v['createdAt']])
             print(f"Found {len(t._rows)} versions in project {project_id}")
             print(t)
         except:
             print("Couldn't find project id")
 
     def list_projects(self) -> NoReturn:
+        from prettytable import PrettyTable
+
         endpoints = self.api.get_projects()
         t = PrettyTable(['title', 'id',
                          'root url', 'created_at'])
@@ -194,10 +162,20 @@ class Forefront:
 
     def deploy(self, model: Any, name: str, description: Optional[str] = None, model_type: Optional[str] = None,
                input_data: Optional[Any] = None,
-               input_shape: Optional[List[Union[int, None]]] = None) -> NoReturn:
-        self.api.deploy_version(name=name, model=model,
-                                model_type=model_type, description=description, input_data=input_data,
-                                input_shape=input_shape)
+               input_shape: Optional[List[Union[int, None]]] = None,
+               wait: bool = True) -> Union[Optional[str], Future]:
+        # with wait=False the deploy runs in the background and a Future for
+        # the version id is returned, e.g. to deploy a sweep of models and
+        # wait on all of them with concurrent.futures.wait
+        if not wait:
+            if self.deploy_executor is None:
+                self.deploy_executor = ThreadPoolExecutor(DEPLOY_WORKERS)
+            return self.deploy_executor.submit(self.deploy, model, name, description, model_type,
+                                               input_data, input_shape)
+
+        return self.api.deploy_version(name=name, model=model,
+                                       model_type=model_type, description=description, input_data=input_data,
+                                       input_shape=input_shape)
 
     def handler(self, cls: Any) -> NoReturn:
         name = cls.__name__
@@ -211,6 +189,7 @@ class Forefront:
                 out += inspect.getsource(getattr(cls, method)) + "\n"
             except:
                 n_failed += 1
+        self.ensure_all_forefront_dirs()
         save_path = os.path.join(
             Path.home(), '.forefront', f'handler-{self.project_id}.py')
 
@@ -230,6 +209,7 @@ class Forefront:
                 out += inspect.getsource(getattr(cls, method)) + "\n"
             except:
                 n_failed += 1
+        self.ensure_all_forefront_dirs()
         save_path = os.path.join(
             Path.home(), '.forefront', f'test-handler-{self.project_id}.py')
 
@@ -240,6 +220,7 @@ class Forefront:
         print('Successfully saved test handler for your current project!')
 
     def set_requirements(self, packages: List[str]) -> NoReturn:
+        self.ensure_all_forefront_dirs()
         with open(os.path.join(Path.home(), '.forefront', f'requirements-{self.state.get_project_id()}.txt'), 'w') as f:
             f.write('\n'.join(packages))
 
@@ -250,9 +231,36 @@ class Forefront:
         self.datasets.upload_dataloader(name=name, description=description, dataloader=dataloader, dataset=dataset_id,
                                         upload_batch=upload_batch)
 
-    def get_dataloader(self, dataset_version_id: Optional[str] = None) -> Iterable:
+    def upload_dataframe(self, df: Any, name: str, description: Optional[str] = None,
+                         dataset_id: Optional[str] = None, columns: Optional[List[str]] = None,
+                         shard_bytes: Optional[int] = 64 * 1024 * 1024) -> str:
+        return self.datasets.upload_dataframe(df, name=name, description=description, dataset=dataset_id,
+                                              columns=columns, shard_bytes=shard_bytes)
+
+    def upload_arrays(self, *arrays: Any, name: str, description: Optional[str] = None,
+                      dataset_id: Optional[str] = None, shard_rows: Optional[int] = None,
+                      shard_bytes: Optional[int] = None) -> str:
+        return self.datasets.upload_arrays(*arrays, name=name, description=description, dataset=dataset_id,
+                                           shard_rows=shard_rows, shard_bytes=shard_bytes)
+
+    def append_dataloader(self, dataset_version_id: str, dataloader: Iterable,
+                          upload_batch: Optional[int] = 32) -> str:
+        return self.datasets.append(dataset_version_id, dataloader, upload_batch=upload_batch)
+
+    def get_dataloader(self, dataset_version_id: Optional[str] = None, rank: int = 0, world_size: int = 1,
+                       worker_id: int = 0, num_workers: int = 1, epoch: int = 0, seed: int = 0,
+                       columns: Optional[List[int]] = None) -> Iterable:
+
+        return self.datasets.get_dataloader(dataset_version_id, rank=rank, world_size=world_size,
+                                            worker_id=worker_id, num_workers=num_workers, epoch=epoch, seed=seed,
+                                            columns=columns)
+
+    def materialize(self, dataset_version_id: str, path: Optional[str] = None,
+                    columns: Optional[List[int]] = None) -> Tuple:
+        return self.datasets.materialize(dataset_version_id, path, columns)
 
-        return self.datasets.get_dataloader(dataset_version_id)
+    def get_dataset_stats(self, dataset_version_id: str, dataset_id: Optional[str] = None) -> List[Any]:
+        return self.datasets.get_dataset_stats(dataset_version_id, dataset_id)
 
     def list_datasets(self):
         return self.datasets.list_datasets();
@@ -0,0 +1,45 @@
+import os
+import random
+import tempfile
+from typing import Any
+from . import instrumentation
+
+
+def predict(endpoint: str, data: Any, key: str) -> Any:
+    if endpoint is None:
+        raise Exception('Must include and endpoint')
+    if data is None:
+        raise Exception('Must include data to call endpoint with!')
+    # numpy is only imported here so that importing predict stays cheap for
+    # short-lived workers; callers passing an ndarray have loaded it already
+    import numpy as np
+
+    if not isinstance(data, np.ndarray):
+        raise Exception('Data must be a numpy.ndarray')
+
+    directory = tempfile.gettempdir()
+    path = os.path.join(directory, f'{random.randint(10000, 100000)}.npy')
+    with instrumentation.span('predict.serialize', stage='predict'):
+        np.save(path, data)
+
+    with open(path, 'rb') as f:
+        res = instrumentation.request('POST', endpoint, stage='predict', files={'model_file': f}, headers={
+            'authorization': f"Bearer {key}"
+        })
+
+    os.remove(path)
+
+    if (res.status_code == 404):
+        raise Exception('Endpoint is down!')
+
+    if (res.status_code == 401):
+        raise Exception('Your authentication is wrong!')
+
+    if (res.status_code != 200):
+        print(res.text)
+        raise Exception('Something went wrong with the request!')
+
+    try:
+        return res.json()
+    except Exception:
+        raise Exception('Endpoint response is malformed!')
@@ -0,0 +1,238 @@
+import atexit
+import json
+import threading
+import time
+from typing import Optional, Any, List, Dict, Callable, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import requests
+
+# timing hooks for the http calls and dataset pipelines. everything here is
+# off by default: span() hands back a shared no-op object and request() goes
+# straight to the pooled session, so the disabled cost is one flag check.
+
+
+class Span:
+    name: str
+    attributes: Dict[str, Any]
+    start: float
+    duration: float
+
+    def __init__(self, name: str, attributes: Dict[str, Any]):
+        self.name = name
+        self.attributes = attributes
+        self.start = 0.0
+        self.duration = 0.0
+
+    def set(self, **attributes: Any) -> 'Span':
+        self.attributes.update(attributes)
+        return self
+
+    def __enter__(self) -> 'Span':
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type: Any, exc: Any, tb: Any):
+        self.duration = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.attributes['error'] = exc_type.__name__
+        emit(self)
+
+
+class NoopSpan:
+    def set(self, **attributes: Any) -> 'NoopSpan':
+        return self
+
+    def __enter__(self) -> 'NoopSpan':
+        return self
+
+    def __exit__(self, exc_type: Any, exc: Any, tb: Any):
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+
+# attributes that become metric labels; everything else is only passed to
+# hooks, which keeps label cardinality bounded
+LABELS = ('stage', 'method', 'status')
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.spans: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], List[float]] = {}
+        self.bytes: Dict[Tuple[str, str, Tuple[Tuple[str, str], ...]], int] = {}
+
+    def record(self, span: Span):
+        labels = tuple((k, str(span.attributes[k])) for k in LABELS if k in span.attributes)
+        with self.lock:
+            entry = self.spans.setdefault((span.name, labels), [0, 0.0, 0])
+            entry[0] += 1
+            entry[1] += span.duration
+            entry[2] += span.attributes.get('retries', 0)
+            for direction in ('sent', 'received'):
+                n_bytes = span.attributes.get(f'bytes_{direction}')
+                if n_bytes:
+                    key = (span.name, direction, labels)
+                    self.bytes[key] = self.bytes.get(key, 0) + n_bytes
+
+    def reset(self):
+        with self.lock:
+            self.spans.clear()
+            self.bytes.clear()
+
+    def to_json(self) -> Any:
+        with self.lock:
+            return {
+                'spans': [{'name': name, 'labels': dict(labels), 'count': count, 'seconds': seconds,
+                           'retries': retries}
+                          for (name, labels), (count, seconds, retries) in sorted(self.spans.items())],
+                'bytes': [{'name': name, 'direction': direction, 'labels': dict(labels), 'bytes': n_bytes}
+                          for (name, direction, labels), n_bytes in sorted(self.bytes.items())],
+            }
+
+    def to_prometheus(self) -> str:
+        def format_labels(labels: Dict[str, str]) -> str:
+            return ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                            for k, v in labels.items())
+
+        snapshot = self.to_json()
+        lines = [
+            '# TYPE forefront_span_seconds summary',
+        ]
+        for s in snapshot['spans']:
+            labels = format_labels(dict(span=s['name'], **s['labels']))
+            lines.append(f"forefront_span_seconds_count{{{labels}}} {s['count']}")
+            lines.append(f"forefront_span_seconds_sum{{{labels}}} {s['seconds']:.6f}")
+        lines.append('# TYPE forefront_retries_total counter')
+        for s in snapshot['spans']:
+            if s['retries'] > 0:
+                labels = format_labels(dict(span=s['name'], **s['labels']))
+                lines.append(f"forefront_retries_total{{{labels}}} {s['retries']}")
+        lines.append('# TYPE forefront_bytes_total counter')
+        for b in snapshot['bytes']:
+            labels = format_labels(dict(span=b['name'], direction=b['direction'], **b['labels']))
+            lines.append(f"forefront_bytes_total{{{labels}}} {b['bytes']}")
+
+        return '\n'.join(lines) + '\n'
+
+
+enabled = False
+hooks: List[Callable[[Span], Any]] = []
+metrics = Metrics()
+session: Optional['requests.Session'] = None
+session_lock = threading.Lock()
+
+
+def enable(export_path: Optional[str] = None, export_format: str = 'json'):
+    global enabled
+    enabled = True
+
+    if export_path is not None:
+        atexit.register(export, export_path, export_format)
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def add_hook(hook: Callable[[Span], Any]):
+    hooks.append(hook)
+
+
+def remove_hook(hook: Callable[[Span], Any]):
+    hooks.remove(hook)
+
+
+def span(name: str, **attributes: Any) -> Any:
+    if not enabled:
+        return NOOP_SPAN
+    return Span(name, attributes)
+
+
+def emit(s: Span):
+    metrics.record(s)
+    for hook in hooks:
+        hook(s)
+
+
+def export(path: str, export_format: str = 'json'):
+    if export_format == 'prometheus':
+        out = metrics.to_prometheus()
+    elif export_format == 'json':
+        out = json.dumps(metrics.to_json(), indent=2)
+    else:
+        raise ValueError("export_format must be either 'json' or 'prometheus'")
+
+    with open(path, 'w') as f:
+        f.write(out)
+
+
+def get_body_size(body: Any) -> int:
+    if body is None:
+        return 0
+    if isinstance(body, (bytes, bytearray, str)):
+        return len(body)
+    return 0
+
+
+def get_session() -> 'requests.Session':
+    # requests is created on the first call rather than at import time,
+    # it accounts for a large share of the package's import cost
+    global session
+    if session is None:
+        with session_lock:
+            if session is None:
+                import requests
+                session = requests.Session()
+    return session
+
+
+def request(method: str, url: str, stage: str = 'http', **kwargs: Any) -> 'requests.Response':
+    if not enabled:
+        return get_session().request(method, url, **kwargs)
+
+    with Span('http.request', {'stage': stage, 'method': method}) as s:
+        res = get_session().request(method, url, **kwargs)
+        # requests only exposes time to response headers, so ttfb covers
+        # dns, connect and server time; transfer is the body download
+        ttfb = res.elapsed.total_seconds()
+        s.set(status=res.status_code, ttfb=ttfb, url=url,
+              bytes_sent=get_body_size(res.request.body))
+        if not kwargs.get('stream'):
+            s.set(bytes_received=len(res.content))
+        s.set(transfer=max(time.perf_counter() - s.start - ttfb, 0.0))
+
+    return res
+
+
+class TimedStream:
+    # wraps a file-like object to attribute time spent blocked on reads,
+    # e.g. the network, separately from whatever consumes the data
+    def __init__(self, stream: Any, name: str, **attributes: Any):
+        self.stream = stream
+        self.span = Span(name, attributes)
+        self.bytes = 0
+
+    def read(self, size: int = -1) -> bytes:
+        start = time.perf_counter()
+        data = self.stream.read(size)
+        self.span.duration += time.perf_counter() - start
+        self.bytes += len(data)
+        return data
+
+    def finish(self):
+        self.span.set(bytes_received=self.bytes)
+        emit(self.span)
+
+
+def timed_stream(stream: Any, name: str, **attributes: Any) -> Any:
+    if not enabled:
+        return stream
+    return TimedStream(stream, name, **attributes)
+
+
+def finish_stream(stream: Any):
+    if isinstance(stream, TimedStream):
+        stream.finish()
@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from typing import Optional, Any, List, Dict
+from urllib.parse import urlencode
+from . import instrumentation
+
+# listings of projects, versions and datasets are kept on disk and served
+# without a request for this many seconds. after that they are revalidated
+# with If-None-Match, and servers that support it only send what changed
+# since the last fetch, marked with this header
+METADATA_TTL = 60
+INCREMENTAL_HEADER = 'X-Forefront-Incremental'
+
+# incremental responses only drop deleted items the server marks as such,
+# so the full listing is fetched again once every this many ttls
+FULL_RESYNC_TTLS = 10
+
+
+def merge_listing(old: List[Any], changes: List[Any]) -> List[Any]:
+    items = {item['_id']: item for item in old}
+    for item in changes:
+        if item.get('deleted'):
+            items.pop(item['_id'], None)
+        else:
+            items[item['_id']] = item
+    return list(items.values())
+
+
+def get_server_time(res: Any) -> Optional[float]:
+    try:
+        return parsedate_to_datetime(res.headers['Date']).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class MetadataCache:
+    path: str
+    ttl: float
+    data: Optional[Dict[str, Any]]
+
+    def __init__(self, path: Optional[str] = None, ttl: float = METADATA_TTL):
+        self.path = path if path is not None else os.path.join(Path.home(), '.forefront', 'metadata.json')
+        self.ttl = ttl
+        self.data = None
+        self.lock = threading.RLock()
+
+    def load(self) -> Dict[str, Any]:
+        with self.lock:
+            if self.data is None:
+                try:
+                    with open(self.path, 'r') as f:
+                        self.data = json.load(f)
+                except (OSError, ValueError):
+                    self.data = {}
+                self.data.setdefault('listings', {})
+                self.data.setdefault('ids', {})
+            return self.data
+
+    def save(self):
+        # last writer wins, which is fine for a cache. the rename keeps
+        # readers from seeing a partial file
+        try:
+            folder = os.path.dirname(self.path)
+            Path(folder).mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.metadata-')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.data, f)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def make_key(url: str, key: str, params: Optional[Dict[str, str]] = None) -> str:
+        # listings differ per account, so entries are scoped to the token
+        account = hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+        query = urlencode(sorted((params or {}).items()))
+        return f'{account} {url}?{query}'
+
+    def get(self, url: str, key: str, params: Optional[Dict[str, str]] = None, stage: str = 'metadata',
+            refresh: bool = False) -> Any:
+        cache_key = self.make_key(url, key, params)
+        with self.lock:
+            entry = self.load()['listings'].get(cache_key)
+
+        if entry is not None and not refresh and time.time() - entry['fetchedAt'] < self.ttl:
+            return entry['data']
+
+        headers = {'Authorization': key}
+        request_params = dict(params or {})
+        # a refresh or a periodic resync fetches the whole listing
+        # unconditionally, so items deleted without a tombstone go away
+        full = entry is None or refresh or \
+            time.time() - entry.get('syncedAt', 0) >= self.ttl * FULL_RESYNC_TTLS
+        if not full:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('serverTime') is not None and isinstance(entry['data'], list):
+                # a second of overlap, merging the same item twice is harmless
+                request_params['updatedSince'] = str(int(entry['serverTime']) - 1)
+
+        res = instrumentation.request('GET', url, stage=stage, params=request_params, headers=headers)
+
+        if res.status_code == 304 and not full:
+            data = entry['data']
+        elif res.status_code == 200:
+            data = res.json()
+            if not full and res.headers.get(INCREMENTAL_HEADER) == 'true':
+                data = merge_listing(entry['data'], data)
+        else:
+            # errors aren't cached, callers handle the response as before
+            return res.json()
+
+        with self.lock:
+            self.load()['listings'][cache_key] = {
+                'etag': res.headers.get('ETag') or (entry or {}).get('etag'),
+                'serverTime': get_server_time(res),
+                'fetchedAt': time.time(),
+                'syncedAt': time.time() if full else entry.get('syncedAt', 0),
+                'data': data,
+            }
+            self.save()
+
+        return data
+
+    def invalidate(self, url: str):
+        with self.lock:
+            listings = self.load()['listings']
+            for cache_key in [k for k in listings if k.split(' ', 1)[1].split('?')[0] == url]:
+                del listings[cache_key]
+            self.save()
+
+    def get_id(self, kind: str, id: str) -> Optional[str]:
+        # resolved ids that never change, e.g. the dataset of a version
+        return self.load()['ids'].get(f'{kind}:{id}')
+
+    def set_id(self, kind: str, id: str, value: str):
+        with self.lock:
+            self.load()['ids'][f'{kind}:{id}'] = value
+            self.save()
+
+
+cache: Optional[MetadataCache] = None
+cache_lock = threading.Lock()
+
+
+def get_metadata_cache() -> MetadataCache:
+    global cache
+    if cache is None:
+        with cache_lock:
+            if cache is None:
+                cache = MetadataCache()
+    return cache
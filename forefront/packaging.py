@@ -0,0 +1,127 @@
+import hashlib
+import json
+import mmap
+import pickle
+import struct
+import sys
+from typing import Optional, Any, List, BinaryIO
+
+# packaged model layout:
+#   8 byte magic | uint64 header length | json header | padding | pickle | buffers
+# the model is pickled with protocol 5 and large buffers (e.g. numpy weights)
+# are written out-of-band as aligned segments, straight from the arrays'
+# memory, so loading can map them instead of copying them out of a pickle
+MODEL_MAGIC = b'FFMODEL1'
+MODEL_ALIGNMENT = 64
+MODEL_PREFIX_SIZE = len(MODEL_MAGIC) + 8
+MODEL_EXTENSION = 'ffmodel'
+
+# protocol 5 needs python 3.8, older interpreters upload a plain pickle
+# like older versions of the library did
+PICKLE_FORMAT = 'pkl'
+
+# smaller buffers stay inside the pickle
+MIN_OUT_OF_BAND_BYTES = 64 * 1024
+
+
+def align(n: int) -> int:
+    return (n + MODEL_ALIGNMENT - 1) // MODEL_ALIGNMENT * MODEL_ALIGNMENT
+
+
+def is_packaged_model(prefix: bytes) -> bool:
+    return prefix[:len(MODEL_MAGIC)] == MODEL_MAGIC
+
+
+def get_model_format() -> str:
+    return MODEL_EXTENSION if sys.version_info >= (3, 8) else PICKLE_FORMAT
+
+
+def save_pickle(model: Any, path: str) -> str:
+    data = pickle.dumps(model)
+    with open(path, 'wb') as f:
+        f.write(data)
+    return hashlib.sha256(data).hexdigest()
+
+
+def save_model(model: Any, path: str) -> str:
+    if get_model_format() == PICKLE_FORMAT:
+        return save_pickle(model, path)
+
+    buffers: List[memoryview] = []
+
+    def buffer_callback(buffer: pickle.PickleBuffer) -> bool:
+        try:
+            raw = buffer.raw()
+        except BufferError:
+            # non-contiguous buffers can't be written as a single segment
+            return True
+        if raw.nbytes < MIN_OUT_OF_BAND_BYTES:
+            return True
+        buffers.append(raw)
+        return False
+
+    data = pickle.dumps(model, protocol=5, buffer_callback=buffer_callback)
+
+    segments: List[Any] = []
+    offset = 0
+    for segment in [memoryview(data)] + buffers:
+        segments.append({'offset': offset, 'nbytes': segment.nbytes})
+        offset = align(offset + segment.nbytes)
+
+    header = json.dumps({
+        'version': 1,
+        'alignment': MODEL_ALIGNMENT,
+        'pickle': segments[0],
+        'buffers': segments[1:],
+    }).encode('utf-8')
+    data_offset = align(MODEL_PREFIX_SIZE + len(header))
+
+    # the file is hashed as it's written, so uploading it doesn't need
+    # another pass over the weights
+    digest = hashlib.sha256()
+
+    def write(f: BinaryIO, block: Any):
+        f.write(block)
+        digest.update(block)
+
+    with open(path, 'wb') as f:
+        write(f, MODEL_MAGIC)
+        write(f, struct.pack('<Q', len(header)))
+        write(f, header)
+        write(f, b'\0' * (data_offset - MODEL_PREFIX_SIZE - len(header)))
+
+        position = 0
+        for element, segment in zip(segments, [memoryview(data)] + buffers):
+            write(f, b'\0' * (element['offset'] - position))
+            write(f, segment)
+            position = element['offset'] + element['nbytes']
+
+    return digest.hexdigest()
+
+
+def load_model(path: str, use_mmap: Optional[bool] = True) -> Any:
+    with open(path, 'rb') as f:
+        prefix = f.read(MODEL_PREFIX_SIZE)
+        if not is_packaged_model(prefix):
+            # a plain pickle, as written by older versions
+            f.seek(0)
+            return pickle.load(f)
+
+        if use_mmap:
+            # copy-on-write, so arrays come back writable without the
+            # changes reaching the file
+            data: Any = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY))
+        else:
+            f.seek(0)
+            data = memoryview(bytearray(f.read()))
+
+    (length,) = struct.unpack('<Q', prefix[len(MODEL_MAGIC):])
+    header = json.loads(bytes(data[MODEL_PREFIX_SIZE:MODEL_PREFIX_SIZE + length]).decode('utf-8'))
+    data_offset = align(MODEL_PREFIX_SIZE + length)
+
+    def get_segment(element: Any) -> memoryview:
+        start = data_offset + element['offset']
+        return data[start:start + element['nbytes']]
+
+    return pickle.loads(get_segment(header['pickle']),
+                        buffers=[get_segment(b) for b in header['buffers']])
@@ -0,0 +1,95 @@
+import numpy as np
+from typing import Optional, Any, List, Union, Iterator, Sequence
+
+
+class RaggedArray:
+    values: np.ndarray
+    offsets: np.ndarray
+
+    # item i is values[offsets[i]:offsets[i + 1]], a view into values
+    def __init__(self, values: np.ndarray, offsets: np.ndarray):
+        offsets = np.asarray(offsets, dtype=np.int64)
+        if offsets.ndim != 1 or len(offsets) == 0 or offsets[0] != 0:
+            raise ValueError('Ragged offsets must be a 1d array starting at 0!')
+        if np.any(np.diff(offsets) < 0) or offsets[-1] != len(values):
+            raise ValueError('Ragged offsets must be increasing and end at the number of values!')
+
+        self.values = values
+        self.offsets = offsets
+
+    @classmethod
+    def from_arrays(cls, arrays: Sequence[Any], dtype: Optional[Any] = None) -> 'RaggedArray':
+        arrays = [np.asarray(a, dtype=dtype) for a in arrays]
+        offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        np.cumsum([len(a) for a in arrays], out=offsets[1:])
+
+        if len(arrays) > 0:
+            values = np.concatenate(arrays)
+        else:
+            values = np.zeros(0, dtype=dtype if dtype is not None else np.float64)
+
+        return cls(values, offsets)
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.values.dtype
+
+    @property
+    def nbytes(self) -> int:
+        return self.values.nbytes + self.offsets.nbytes
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[np.ndarray, 'RaggedArray']:
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise IndexError('Ragged arrays only support contiguous slices')
+            stop = max(start, stop)
+            offsets = self.offsets[start:stop + 1]
+            return RaggedArray(self.values[offsets[0]:offsets[-1]], offsets - offsets[0])
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Ragged index out of range')
+        return self.values[self.offsets[index]:self.offsets[index + 1]]
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self) -> str:
+        return f'RaggedArray(items={len(self)}, values={self.values.shape}, dtype={self.dtype})'
+
+    def to_list(self) -> List[np.ndarray]:
+        return list(self)
+
+
+def is_ragged_input(item: Any) -> bool:
+    if isinstance(item, RaggedArray):
+        return True
+    if isinstance(item, np.ndarray):
+        # other object arrays, e.g. of strings, are left to be rejected as
+        # object arrays when the shard is written
+        if item.dtype != object or item.ndim != 1:
+            return False
+        item = list(item)
+    if isinstance(item, list):
+        return len(item) > 0 and all(isinstance(a, np.ndarray) for a in item)
+    return False
+
+
+def as_column(item: Any) -> Union[np.ndarray, RaggedArray]:
+    # object arrays and lists of arrays become ragged columns instead of
+    # being pickled or padded
+    if isinstance(item, RaggedArray):
+        return item
+    if is_ragged_input(item):
+        return RaggedArray.from_arrays(list(item))
+    return np.asarray(item)
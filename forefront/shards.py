@@ -0,0 +1,232 @@
+import numpy as np
+from typing import Optional, Any, List, Tuple, Iterable, Iterator, BinaryIO, Dict, Union
+from .ragged import RaggedArray, as_column
+import json
+import struct
+import zlib
+
+# indexed shard layout:
+#   8 byte magic | uint64 header length | json header | padding | data blocks
+# every block starts on an aligned offset (relative to the first block) and
+# blocks are written column by column, so one column is one contiguous range
+SHARD_MAGIC = b'FFSHARD1'
+SHARD_ALIGNMENT = 64
+SHARD_PREFIX_SIZE = len(SHARD_MAGIC) + 8
+SHARD_EXTENSION = 'ffs'
+
+
+def align(n: int) -> int:
+    return (n + SHARD_ALIGNMENT - 1) // SHARD_ALIGNMENT * SHARD_ALIGNMENT
+
+
+def array_to_bytes(array: np.ndarray) -> np.ndarray:
+    # a flat uint8 view, which is zero-copy for C-contiguous input
+    return np.ascontiguousarray(array).reshape(-1).view(np.uint8)
+
+
+def read_exact(f: BinaryIO, size: int) -> bytes:
+    chunks: List[bytes] = []
+    remaining = size
+    while remaining > 0:
+        chunk = f.read(remaining)
+        if not chunk:
+            raise EOFError('Shard ended unexpectedly!')
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
+
+
+def is_indexed_shard(prefix: bytes) -> bool:
+    return prefix[:len(SHARD_MAGIC)] == SHARD_MAGIC
+
+
+def write_shard(path: str, samples: List[Tuple[int, Tuple[np.ndarray]]], compress: Optional[bool] = False) -> str:
+    n_columns = len(samples[0][1]) if len(samples) > 0 else 0
+
+    elements: List[Any] = []
+    blocks: List[Any] = []
+    offset = 0
+    for column in range(n_columns):
+        for sample, data in samples:
+            if len(data) != n_columns:
+                raise Exception('Every tuple in a shard must have the same number of arrays!')
+
+            item = as_column(data[column])
+            if isinstance(item, RaggedArray):
+                parts = [('values', item.values), ('offsets', item.offsets)]
+            else:
+                parts = [(None, item)]
+
+            for part, array in parts:
+                if array.dtype.hasobject:
+                    raise Exception('Object arrays can not be uploaded! Convert column {} to a numeric dtype.'.format(
+                        column))
+
+                block = array_to_bytes(array)
+                if compress:
+                    block = zlib.compress(block)
+
+                elements.append({
+                    'sample': sample,
+                    'column': column,
+                    'ragged': part,
+                    'dtype': np.lib.format.dtype_to_descr(array.dtype),
+                    'shape': list(array.shape),
+                    'offset': offset,
+                    'nbytes': len(block),
+                    'compression': 'zlib' if compress else None,
+                })
+                blocks.append(block)
+                offset = align(offset + len(block))
+
+    header = json.dumps({
+        'version': 1,
+        'samples': len(samples),
+        'columns': n_columns,
+        'alignment': SHARD_ALIGNMENT,
+        'elements': elements,
+    }).encode('utf-8')
+    data_offset = align(SHARD_PREFIX_SIZE + len(header))
+
+    with open(path, 'wb') as f:
+        f.write(SHARD_MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        f.write(b'\0' * (data_offset - SHARD_PREFIX_SIZE - len(header)))
+
+        position = 0
+        for element, block in zip(elements, blocks):
+            f.write(b'\0' * (element['offset'] - position))
+            f.write(block)
+            position = element['offset'] + element['nbytes']
+
+    return path
+
+
+def get_header_size(prefix: bytes) -> int:
+    if not is_indexed_shard(prefix):
+        raise ValueError('Not an indexed shard!')
+    (length,) = struct.unpack('<Q', prefix[len(SHARD_MAGIC):SHARD_PREFIX_SIZE])
+    return SHARD_PREFIX_SIZE + length
+
+
+def parse_header(data: bytes) -> Tuple[Any, int]:
+    size = get_header_size(data)
+    header = json.loads(data[SHARD_PREFIX_SIZE:size].decode('utf-8'))
+    return header, align(size)
+
+
+def read_header(path: str) -> Tuple[Any, int]:
+    with open(path, 'rb') as f:
+        prefix = read_exact(f, SHARD_PREFIX_SIZE)
+        return parse_header(prefix + read_exact(f, get_header_size(prefix) - SHARD_PREFIX_SIZE))
+
+
+def get_shard_size(header: Any, data_offset: int) -> int:
+    return data_offset + max([e['offset'] + e['nbytes'] for e in header['elements']], default=0)
+
+
+def select_elements(header: Any, columns: Optional[List[int]] = None) -> List[Any]:
+    elements = [e for e in header['elements'] if columns is None or e['column'] in columns]
+    return sorted(elements, key=lambda e: e['offset'])
+
+
+def get_byte_ranges(header: Any, data_offset: int, columns: Optional[List[int]] = None) -> List[Tuple[int, int]]:
+    # half-open absolute byte ranges covering the selected elements, with
+    # neighbouring blocks merged so each column costs a single range read
+    ranges: List[Tuple[int, int]] = []
+    for e in select_elements(header, columns):
+        start, end = data_offset + e['offset'], data_offset + e['offset'] + e['nbytes']
+        if len(ranges) > 0 and align(ranges[-1][1]) >= start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+
+def decode_element(element: Any, buffer: Any) -> np.ndarray:
+    if element['compression'] == 'zlib':
+        buffer = zlib.decompress(buffer)
+    elif element['compression'] is not None:
+        raise ValueError('Unknown shard compression {}'.format(element['compression']))
+
+    dtype = np.lib.format.descr_to_dtype(element['dtype'])
+    shape = tuple(element['shape'])
+    count = int(np.prod(shape, dtype=np.int64))
+    return np.frombuffer(buffer, dtype=dtype, count=count).reshape(shape)
+
+
+def iter_stream_elements(f: BinaryIO, columns: Optional[List[int]] = None,
+                         prefix: bytes = b'') -> Iterator[Tuple[Any, np.ndarray]]:
+    # sequential reader for a non-seekable stream, e.g. an http response;
+    # unselected blocks are read past without being decoded
+    prefix += read_exact(f, SHARD_PREFIX_SIZE - len(prefix))
+    header_size = get_header_size(prefix)
+    header, data_offset = parse_header(prefix + read_exact(f, header_size - SHARD_PREFIX_SIZE))
+
+    position = header_size
+    selected = {id(e) for e in select_elements(header, columns)}
+    for e in sorted(header['elements'], key=lambda e: e['offset']):
+        start = data_offset + e['offset']
+        read_exact(f, start - position)
+        block = read_exact(f, e['nbytes'])
+        position = start + e['nbytes']
+
+        if id(e) in selected:
+            yield e, decode_element(e, block)
+
+
+def iter_range_elements(header: Any, data_offset: int, ranges: Iterable[Tuple[int, bytes]],
+                        columns: Optional[List[int]] = None) -> Iterator[Tuple[Any, np.ndarray]]:
+    # ranges are (absolute start, bytes) pairs as returned by range reads
+    ranges = list(ranges)
+    for e in select_elements(header, columns):
+        start = data_offset + e['offset']
+        for range_start, data in ranges:
+            if range_start <= start and start + e['nbytes'] <= range_start + len(data):
+                block = data[start - range_start:start - range_start + e['nbytes']]
+                yield e, decode_element(e, block)
+                break
+
+
+def group_elements(elements: Iterable[Tuple[Any, np.ndarray]]) -> Dict[Tuple[int, int], Any]:
+    # joins the values and offsets parts of ragged columns, keyed by
+    # (sample, column)
+    items: Dict[Tuple[int, int], Any] = {}
+    for e, array in elements:
+        key = (e['sample'], e['column'])
+        if e.get('ragged') is None:
+            items[key] = array
+        else:
+            items.setdefault(key, {})[e['ragged']] = array
+
+    for key, item in items.items():
+        if isinstance(item, dict):
+            items[key] = RaggedArray(item['values'], item['offsets'])
+
+    return items
+
+
+def read_shard_items(path: str, columns: Optional[List[int]] = None) -> Dict[Tuple[int, int], Any]:
+    # uncompressed blocks come back as views into a read-only memory map, so
+    # only the pages of the selected columns are ever read. blocks of other
+    # columns may be missing from a cached shard, they are never touched
+    header, data_offset = read_header(path)
+    data = np.memmap(path, dtype=np.uint8, mode='r')
+
+    def elements() -> Iterator[Tuple[Any, np.ndarray]]:
+        for e in select_elements(header, columns):
+            start = data_offset + e['offset']
+            block = data[start:start + e['nbytes']]
+            if e['compression'] is None:
+                dtype = np.lib.format.descr_to_dtype(e['dtype'])
+                yield e, block.view(dtype).reshape(tuple(e['shape']))
+            else:
+                yield e, decode_element(e, bytes(block))
+
+    return group_elements(elements())
+
+
+def read_shard(path: str, columns: Optional[List[int]] = None) -> Tuple[Union[np.ndarray, RaggedArray]]:
+    items = read_shard_items(path, columns)
+    return tuple(items[key] for key in sorted(items))
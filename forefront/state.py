@@ -1,78 +1,172 @@
 import os
-from typing import NoReturn
+import json
+import tempfile
+import threading
+from typing import NoReturn, Optional, Any, Dict
 from pathlib import Path
 
+try:
+    import fcntl
+except ImportError:
+    # windows, where concurrent writers are not locked against each other
+    fcntl = None
+
+# environment variables take precedence over the config file, so containers
+# can be configured without touching the home directory at all. once the
+# token comes from the environment the config file is neither read nor
+# written, values set at runtime are only kept in memory
+ENV_OVERRIDES = {
+    'token': 'FOREFRONT_TOKEN',
+    'project_id': 'FOREFRONT_PROJECT_ID',
+    'org_id': 'FOREFRONT_ORG_ID',
+    'dataset': 'FOREFRONT_DATASET',
+}
+
+# files written by older versions, one value per file. the default dataset
+# used to end up in upload_status
+LEGACY_FILES = {
+    'token': 'credentials',
+    'project_id': 'project',
+    'org_id': 'org',
+    'dataset': 'upload_status',
+}
+
 
 class State:
 
-    credentials_path: str
     global_forefront_dir: str
-    project_id_path: str
-    org_id_path: str
+    config_path: str
+    lock_path: str
+    config: Optional[Dict[str, Any]]
 
     def __init__(self):
         self.global_forefront_dir = os.path.join(Path.home(), '.forefront')
-        self.credentials_path = os.path.join(
-            self.global_forefront_dir, 'credentials')
-        self.project_id_path = os.path.join(
-            self.global_forefront_dir, 'project')
-        self.org_id_path = os.path.join(self.global_forefront_dir, 'org')
-        self.dataset = os.path.join(self.global_forefront_dir, 'dataset')
-        self.upload_status = os.path.join(
-            self.global_forefront_dir, 'upload_status')
+        self.config_path = os.path.join(self.global_forefront_dir, 'config.json')
+        self.lock_path = os.path.join(self.global_forefront_dir, 'config.lock')
+        self.config = None
+        self.lock = threading.Lock()
 
-    def set_token(self, token: str) -> NoReturn:
-        with open(self.credentials_path, 'w') as f:
-            f.write(token.strip())
+    def read_config(self) -> Dict[str, Any]:
+        try:
+            with open(self.config_path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            print(f'Ignoring malformed config at {self.config_path}')
+            return {}
+
+    def read_legacy_config(self) -> Dict[str, Any]:
+        config = {}
+        for key, filename in LEGACY_FILES.items():
+            try:
+                with open(os.path.join(self.global_forefront_dir, filename), 'r') as f:
+                    value = f.read().strip()
+            except OSError:
+                continue
+            if value != '':
+                config[key] = value
+        return config
+
+    @staticmethod
+    def uses_environment() -> bool:
+        return bool(os.environ.get(ENV_OVERRIDES['token']))
+
+    def load(self) -> Dict[str, Any]:
+        # read once per process, later gets are served from memory
+        if self.config is None:
+            with self.lock:
+                if self.config is None and self.uses_environment():
+                    self.config = {}
+                elif self.config is None:
+                    self.config = self.read_config()
+                    if not os.path.exists(self.config_path):
+                        self.migrate_legacy_config()
+        return self.config
+
+    def migrate_legacy_config(self) -> NoReturn:
+        # one-time move from the per-key files into config.json
+        legacy = self.read_legacy_config()
+        if len(legacy) == 0:
+            return
 
-    def get_token(self) -> str:
         try:
-            with open(self.credentials_path, 'r') as f:
-                token = f.read().strip()
+            self.config = self.merge_config(legacy)
+        except OSError:
+            # read-only home directories still get the legacy values
+            self.config = legacy
+
+    def get(self, key: str, default: Any = None) -> Any:
+        env = ENV_OVERRIDES.get(key)
+        if env is not None and os.environ.get(env):
+            return os.environ[env].strip()
+        return self.load().get(key, default)
+
+    def update(self, **values: Any) -> NoReturn:
+        config = self.load()
+        with self.lock:
+            if self.uses_environment():
+                self.config = dict(config, **values)
+            else:
+                self.config = self.merge_config(values)
+
+    def merge_config(self, values: Dict[str, Any]) -> Dict[str, Any]:
+        Path(self.global_forefront_dir).mkdir(parents=True, exist_ok=True)
+
+        with open(self.lock_path, 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # re-read under the lock so values written by other processes
+                # since we loaded aren't clobbered
+                config = self.read_config()
+                config.update(values)
+                self.write_config(config)
+                return config
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def write_config(self, config: Dict[str, Any]) -> NoReturn:
+        # written to a temporary file and renamed over the config, so readers
+        # never see a partially written document
+        fd, tmp_path = tempfile.mkstemp(dir=self.global_forefront_dir, prefix='.config-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(config, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.config_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def set(self, key: str, value: Any) -> NoReturn:
+        self.update(**{key: value})
+
+    def set_token(self, token: str) -> NoReturn:
+        self.set('token', token.strip())
 
-            if token is None:
-                return ''
-            return token
-        except:
-            return ''
+    def get_token(self) -> str:
+        return self.get('token', '')
 
     def set_project_id(self, project_id: str) -> NoReturn:
-        with open(self.project_id_path, 'w') as f:
-            f.write(project_id.strip())
+        self.set('project_id', project_id.strip())
 
     def get_project_id(self) -> str:
-        try:
-            with open(self.project_id_path, 'r') as f:
-                project_id = f.read().strip()
-
-            if project_id is None:
-                return ''
-            return project_id.strip()
-        except:
-            return ''
+        return self.get('project_id', '')
 
     def get_org_id(self) -> str:
-        try:
-            with open(self.org_id_path, 'r') as f:
-                org_id = f.read().strip()
-
-            if org_id is None:
-                return ''
-            return org_id.strip()
-        except:
-            return ''
+        return self.get('org_id', '')
 
     def set_org_id(self, org_id: str) -> NoReturn:
-        with open(self.org_id_path, 'w') as f:
-            f.write(org_id.strip())
+        self.set('org_id', org_id.strip())
 
-    def set_default_dataset(self, dataset: str):
-        with open(self.dataset_path, 'w') as f:
-            f.write(dataset.strip())
+    def set_default_dataset(self, dataset: str) -> NoReturn:
+        self.set('dataset', dataset.strip())
 
-    def get_default_dataset(self, dataset: str):
-        with open(self.dataset_path, 'w') as f:
-            f.read().strip()
+    def get_default_dataset(self) -> Optional[str]:
+        return self.get('dataset') or None
 
     def set_data(self, path: str, data: str) -> NoReturn:
         with open(os.path.join(self.global_forefront_dir, path), 'w') as f:
@@ -81,15 +175,3 @@ class State:
     def get_data(self, path: str) -> str:
         with open(os.path.join(self.global_forefront_dir, path), 'r') as f:
             return f.read()
-
-    def get_default_dataset(self):
-        try:
-            with open(self.upload_status, 'r') as f:
-                f.read().strip()
-        except FileNotFoundError:
-            self.set_default_dataset('')
-            return ''
-
-    def set_default_dataset(self, status: str):
-        with open(self.upload_status, 'w') as f:
-            f.write(status.strip())
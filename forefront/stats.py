@@ -0,0 +1,145 @@
+import numpy as np
+from typing import Optional, Any, List, Dict, Union, Iterable
+from .ragged import RaggedArray, as_column
+
+# integer and boolean columns keep exact value counts (e.g. a label
+# distribution) until they have more distinct values than this
+MAX_DISTINCT_VALUES = 1000
+
+
+class ColumnStats:
+    rows: int
+    elements: int
+    count: int
+    nans: int
+    mean: float
+    m2: float
+    min: Optional[float]
+    max: Optional[float]
+    value_counts: Optional[Dict[str, int]]
+
+    def __init__(self):
+        self.rows = 0
+        self.elements = 0
+        self.count = 0
+        self.nans = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.value_counts = {}
+
+    @property
+    def variance(self) -> Optional[float]:
+        return self.m2 / self.count if self.count > 0 else None
+
+    @property
+    def std(self) -> Optional[float]:
+        return float(np.sqrt(self.variance)) if self.count > 0 else None
+
+    def update(self, item: Union[np.ndarray, RaggedArray], sample: bool = False) -> 'ColumnStats':
+        # a single sample is one row however many elements it has, a batch
+        # has a row per item along axis 0
+        item = as_column(item)
+        values = item.values if isinstance(item, RaggedArray) else item
+        self.rows += 1 if sample or (not isinstance(item, RaggedArray) and item.ndim == 0) else len(item)
+        self.elements += values.size
+
+        if values.dtype.kind not in 'biuf':
+            self.value_counts = None
+            return self
+
+        if values.dtype.kind in 'biu' and self.value_counts is not None:
+            keys, counts = np.unique(values, return_counts=True)
+            for key, count in zip(keys.tolist(), counts.tolist()):
+                self.value_counts[str(key)] = self.value_counts.get(str(key), 0) + count
+            if len(self.value_counts) > MAX_DISTINCT_VALUES:
+                self.value_counts = None
+        elif values.dtype.kind == 'f':
+            self.value_counts = None
+
+        values = values.astype(np.float64, copy=False).reshape(-1)
+        if values.dtype.kind == 'f':
+            is_nan = np.isnan(values)
+            n_nans = int(is_nan.sum())
+            if n_nans > 0:
+                self.nans += n_nans
+                values = values[~is_nan]
+
+        if len(values) == 0:
+            return self
+
+        # vectorised over the batch, then folded in with the parallel
+        # form of welford's update
+        batch = ColumnStats()
+        batch.count = len(values)
+        batch.mean = float(values.mean())
+        batch.m2 = float(((values - batch.mean) ** 2).sum())
+        batch.min = float(values.min())
+        batch.max = float(values.max())
+
+        return self.merge(batch, rows=False)
+
+    def merge(self, other: 'ColumnStats', rows: bool = True) -> 'ColumnStats':
+        if rows:
+            self.rows += other.rows
+            self.elements += other.elements
+            self.nans += other.nans
+
+            if self.value_counts is None or other.value_counts is None:
+                self.value_counts = None
+            else:
+                for key, count in other.value_counts.items():
+                    self.value_counts[key] = self.value_counts.get(key, 0) + count
+                if len(self.value_counts) > MAX_DISTINCT_VALUES:
+                    self.value_counts = None
+
+        if other.count == 0:
+            return self
+
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+
+        return self
+
+    def to_dict(self) -> Any:
+        return {
+            'rows': self.rows,
+            'elements': self.elements,
+            'count': self.count,
+            'nans': self.nans,
+            'mean': self.mean if self.count > 0 else None,
+            'm2': self.m2,
+            'variance': self.variance,
+            'std': self.std,
+            'min': self.min,
+            'max': self.max,
+            'valueCounts': self.value_counts,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Any) -> 'ColumnStats':
+        stats = cls()
+        stats.rows = data['rows']
+        stats.elements = data.get('elements', 0)
+        stats.count = data['count']
+        stats.nans = data['nans']
+        stats.mean = data['mean'] or 0.0
+        stats.m2 = data['m2']
+        stats.min = data['min']
+        stats.max = data['max']
+        stats.value_counts = data['valueCounts']
+        return stats
+
+
+def update_stats(stats: List[ColumnStats], data: Iterable[Any], sample: bool = False) -> List[ColumnStats]:
+    for i, item in enumerate(data):
+        if i == len(stats):
+            stats.append(ColumnStats())
+        stats[i].update(item, sample)
+    return stats
@@ -21,7 +21,8 @@ setup(
     extras_require={
         'pytorch': 'forefront-pytorch',
         'tensorflow': 'forefront-tensorflow',
-        'sklearn': 'forefront-sklearn'
+        'sklearn': 'forefront-sklearn',
+        'arrow': 'pyarrow'
     },
     classifiers=[
         'Development Status :: 3 - Alpha',